@@ -2,7 +2,7 @@
 from requests import get
 import os
 from urllib.parse import urlparse
-from process_image import process_image, need_rotation, add_banner
+from process_image import process_image, add_banner, quantize_image
 from time import sleep
 from datetime import datetime
 
@@ -80,12 +80,12 @@ def empty_dir(path):
             os.remove(file_path)  # Remove the file
 
 def prep_image(img_path, title = None, subtitle = None):
-    rotation = 0
-    if need_rotation(img_path):
-        rotation = 1
-    img = process_image(img_path, crop = True, rotation=rotation)
+    # Landscape pictures are rotated, decided from the same open as the processing
+    img = process_image(img_path, crop = True, auto_rotate=True)
     if title != None and subtitle != None:
         img = add_banner(img, title, subtitle)
+    # Dither down to the panel's 16 gray levels, avoids banding in the sky
+    img = quantize_image(img, "floyd-steinberg")
     return img
 
 
@@ -0,0 +1,112 @@
+import datetime
+import hashlib
+import os
+import pickle
+import sqlite3
+import time
+
+# Relative to the working directory, like the other state rss_to_epub.py keeps
+ARTICLE_STORE_PATH = "articles.sqlite3"
+# Articles are forgotten this long after a feed last listed them, or once
+# there are more of them than MAX_ARTICLES, least recently seen first
+MAX_ARTICLE_AGE = 90 * 24 * 60 * 60
+MAX_ARTICLES = 20000
+# Bytes of the GUID's SHA-256 kept as the key
+KEY_BYTES = 16
+# Files of the pickle-based state this replaces, imported on first use
+LEGACY_ARTICLES = "processed_articles.pickle"
+LEGACY_LAST_RUN = "last_run.pickle"
+
+
+class ArticleStore:
+    # The GUIDs of processed articles with the times they were first and
+    # last seen in a feed, plus the time of the last run, in an SQLite
+    # database. Lookups go to the index on disk, nothing is loaded up front.
+    # Changes are written as they're made but stay in one transaction until
+    # commit(), so a run that stops early leaves the previous state intact.
+    # Supports "in" and add() like the set it replaces. A lookup that finds
+    # an article marks it as seen now, so articles a feed keeps listing
+    # don't expire and come back as new
+    def __init__(self, path=ARTICLE_STORE_PATH, max_age=MAX_ARTICLE_AGE, max_articles=MAX_ARTICLES):
+        self.max_age = max_age
+        self.max_articles = max_articles
+        self.path = path
+        self.added = 0
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS articles (key BLOB PRIMARY KEY, first_seen REAL NOT NULL, last_seen REAL) WITHOUT ROWID")
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(articles)")]
+        if "last_seen" not in columns:
+            # Stores from before last_seen was kept
+            self.db.execute("ALTER TABLE articles ADD COLUMN last_seen REAL")
+        self.db.execute("UPDATE articles SET last_seen = first_seen WHERE last_seen IS NULL")
+        self.db.execute("DROP INDEX IF EXISTS articles_first_seen")
+        self.db.execute("CREATE INDEX IF NOT EXISTS articles_last_seen ON articles (last_seen)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value REAL NOT NULL)")
+        self.db.commit()
+        self.import_legacy()
+
+    def key(self, guid):
+        return hashlib.sha256(guid.encode("utf-8")).digest()[:KEY_BYTES]
+
+    def __contains__(self, guid):
+        # One indexed update, it only matches if the article is known
+        return self.db.execute("UPDATE articles SET last_seen = ? WHERE key = ?", (time.time(), self.key(guid))).rowcount > 0
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM articles").fetchone()[0]
+
+    def add(self, guid, first_seen=None):
+        now = time.time()
+        cursor = self.db.execute("INSERT OR IGNORE INTO articles VALUES (?, ?, ?)",
+                                 (self.key(guid), first_seen or now, now))
+        self.added += cursor.rowcount
+
+    def last_run(self):
+        # As a datetime, None if there was no run yet
+        row = self.db.execute("SELECT value FROM state WHERE name = 'last_run'").fetchone()
+        return datetime.datetime.fromtimestamp(row[0]) if row else None
+
+    def set_last_run(self, when=None):
+        when = when or datetime.datetime.now()
+        self.db.execute("INSERT OR REPLACE INTO state VALUES ('last_run', ?)", (when.timestamp(),))
+
+    def expire(self):
+        # Returns the number of articles forgotten
+        removed = self.db.execute("DELETE FROM articles WHERE last_seen < ?", (time.time() - self.max_age,)).rowcount
+        removed += self.db.execute("DELETE FROM articles WHERE key IN (SELECT key FROM articles "
+                                   "ORDER BY last_seen DESC LIMIT -1 OFFSET ?)", (self.max_articles,)).rowcount
+        return removed
+
+    def commit(self):
+        # Expire old articles and make everything since the last commit permanent
+        removed = self.expire()
+        self.db.commit()
+        return removed
+
+    def close(self):
+        # Anything not committed is dropped
+        self.db.close()
+
+    def import_legacy(self):
+        # Take over the pickle files of earlier versions, then remove them
+        if not os.path.exists(LEGACY_ARTICLES) and not os.path.exists(LEGACY_LAST_RUN):
+            return
+        try:
+            if os.path.exists(LEGACY_ARTICLES):
+                with open(LEGACY_ARTICLES, "rb") as f:
+                    for guid in pickle.load(f):
+                        if guid is not None:
+                            self.add(guid)
+            if os.path.exists(LEGACY_LAST_RUN) and self.last_run() is None:
+                with open(LEGACY_LAST_RUN, "rb") as f:
+                    self.set_last_run(pickle.load(f))
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            # A file cut short by an interrupted write, start over without it
+            print(f"Error importing the old article state: {e}")
+        self.commit()
+        print(f"Imported {self.added} processed articles into {self.path}")
+        self.added = 0
+        for path in (LEGACY_ARTICLES, LEGACY_LAST_RUN):
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,129 @@
+from PIL import Image
+from process_image import ImagePipeline, add_banner
+import PIL
+import argparse
+import io
+import itertools
+import json
+import platform
+import sys
+import time
+import numpy as np
+
+# Synthetic inputs, as (width, height) in landscape orientation
+SIZES = {
+    "small": (800, 600),
+    "huge": (6000, 4000),
+}
+ORIENTATIONS = ["landscape", "portrait"]
+FORMATS = ["jpeg", "png", "rgba"]
+STAGES = ["decode", "grayscale", "resize", "rotate", "composite", "banner", "encode"]
+# Differences below this many seconds are noise, never reported as regressions
+NOISE_FLOOR = 0.001
+RESULTS_VERSION = 1
+
+def make_input(size, orientation, image_format):
+    # A deterministic photo-like image: smooth gradients with some noise on
+    # top, so the encoded size and decode cost are realistic
+    width, height = size if orientation == "landscape" else (size[1], size[0])
+    rng = np.random.default_rng(0)
+    x = np.linspace(0, 1, width, dtype=np.float32)
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, np.newaxis]
+    channels = [x * 255 + y * 0, y * 255 + x * 0, (x + y) * 127]
+    pixels = np.stack(channels, axis=2) + rng.normal(0, 12, (height, width, 1))
+    img = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), mode='RGB')
+    buffer = io.BytesIO()
+    if image_format == "jpeg":
+        img.save(buffer, 'JPEG', quality=90)
+    elif image_format == "rgba":
+        img.putalpha(Image.linear_gradient('L').resize(img.size))
+        img.save(buffer, 'PNG', compress_level=1)
+    else:
+        img.save(buffer, 'PNG', compress_level=1)
+    return buffer.getvalue()
+
+def time_stages(pipeline, data, crop, rotation):
+    # Times ImagePipeline.process step by step through its timings hook, plus
+    # the banner apod.py adds and the PNG encode before sending. Returns {stage: seconds}
+    times = {}
+    img = pipeline.process(io.BytesIO(data), crop, rotation, timings=times)
+
+    start = time.perf_counter()
+    add_banner(img, "Benchmark title", "A subtitle for the benchmark banner")
+    times["banner"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    img.save(io.BytesIO(), 'PNG')
+    times["encode"] = time.perf_counter() - start
+    return times
+
+def run_benchmark(sizes, repeats):
+    # Time every stage for every input and crop/rotation combination.
+    # Returns {case name: {"stages": {stage: median seconds}, "total": seconds}}
+    results = {}
+    for size_name, orientation, image_format in itertools.product(sizes, ORIENTATIONS, FORMATS):
+        data = make_input(SIZES[size_name], orientation, image_format)
+        for crop, rotation in itertools.product([False, True], [0, 1, 2, 3]):
+            name = f"{size_name}-{orientation}-{image_format}-{'crop' if crop else 'fit'}-rot{rotation}"
+            pipeline = ImagePipeline()
+            # The first run fills the plan cache and warms up the font cache
+            time_stages(pipeline, data, crop, rotation)
+            runs = [time_stages(pipeline, data, crop, rotation) for _ in range(repeats)]
+            stages = {stage: sorted(run[stage] for run in runs)[len(runs) // 2] for stage in STAGES}
+            results[name] = {"stages": stages, "total": sum(stages.values())}
+            print(f"{name:<36}" + "".join(f"{stages[stage] * 1000:>13.2f}" for stage in STAGES)
+                  + f"{results[name]['total'] * 1000:>13.2f}", file=sys.stderr)
+    return results
+
+def compare(results, baseline, tolerance):
+    # Print the stages that got slower than the baseline by more than
+    # tolerance (a fraction), returns the number of regressions
+    regressions = 0
+    for name, result in results.items():
+        old = baseline["cases"].get(name)
+        if old is None:
+            continue
+        for stage in STAGES + ["total"]:
+            new_time = result["total"] if stage == "total" else result["stages"][stage]
+            old_time = old["total"] if stage == "total" else old["stages"].get(stage)
+            if old_time is None:
+                continue
+            if new_time > old_time * (1 + tolerance) and new_time - old_time > NOISE_FLOOR:
+                regressions += 1
+                print(f"REGRESSION {name} {stage}: {old_time * 1000:.2f}ms -> {new_time * 1000:.2f}ms "
+                      f"({new_time / old_time - 1:+.0%})")
+    old_total = sum(case["total"] for name, case in baseline["cases"].items() if name in results)
+    new_total = sum(result["total"] for name, result in results.items() if name in baseline["cases"])
+    if old_total:
+        print(f"Total over common cases: {old_total:.3f}s -> {new_total:.3f}s ({new_total / old_total - 1:+.1%}), "
+              f"{regressions} regressions above {tolerance:.0%}")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time each stage of the image pipeline on synthetic inputs.")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="Write the results as JSON to this file (default: benchmark.json)")
+    parser.add_argument("--compare", metavar="BASELINE", help="Compare with the results in this JSON file and exit with status 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Slowdown (fraction) of a stage that counts as a regression (default: 0.15)")
+    parser.add_argument("-n", "--repeats", type=int, default=5, help="Timed runs per case, the median is kept (default: 5)")
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=list(SIZES), help="Input sizes to run (default: all)")
+
+    args = parser.parse_args()
+
+    print(f"{'case':<36}" + "".join(f"{stage + ' ms':>13}" for stage in STAGES) + f"{'total ms':>13}", file=sys.stderr)
+    results = {
+        "version": RESULTS_VERSION,
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "machine": platform.machine(),
+        "repeats": args.repeats,
+        "cases": run_benchmark(args.sizes, args.repeats),
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results["cases"], baseline, args.tolerance):
+            sys.exit(1)
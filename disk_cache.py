@@ -0,0 +1,61 @@
+import os
+import threading
+
+# Disk tier shared by FrameCache and HttpCache: one file per entry, written
+# atomically and evicted least recently used first, with the modification
+# time doubling as the last access time. Several processes may use the same
+# directory, so files can disappear under any of them at any time
+TEMP_SUFFIX = ".tmp"
+
+
+def read_entry(path):
+    # Returns the file's content and marks it as used, None if it's gone
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        # Evicted by another process right after the read
+        pass
+    return data
+
+
+def write_entry(path, data):
+    # Write to a temporary name first so a partial file is never read back.
+    # It's unique to this thread, other writers may store the same entry
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}{TEMP_SUFFIX}"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+def evict(directory, limit, suffix="", companions=()):
+    # Remove the least recently used entries until the files ending in
+    # suffix add up to at most limit bytes. companions are the suffixes of
+    # files that belong to an entry and go with it (not counted)
+    entries = []
+    total = 0
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.endswith(suffix) and not entry.name.endswith(TEMP_SUFFIX):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+    entries.sort()
+    for _, size, path in entries:
+        if total <= limit:
+            break
+        base = path[:len(path) - len(suffix)]
+        for entry_suffix in (suffix,) + tuple(companions):
+            try:
+                os.remove(base + entry_suffix)
+            except FileNotFoundError:
+                # Another process evicted it first, it's gone either way
+                pass
+        total -= size
@@ -0,0 +1,321 @@
+#!/usr/bin/python3.9
+# Resident display agent for the Kindle. Keeps the framebuffer open and
+# accepts framed messages on a socket, so drawing a frame costs no sshd fork,
+# shell or eips launch. kindle_display.py talks to it through an ssh port
+# forward and falls back to plain ssh commands when it isn't running.
+#
+# Only needs the standard library and the FBInk bindings, copy it to the
+# Kindle on its own (e.g. /mnt/us/scripts/) and start it in the background.
+# On Linux, --file draws into a raw 8-bit grayscale file instead, for testing.
+import argparse
+import os
+import socket
+import socketserver
+import struct
+import subprocess
+import threading
+import time
+import zlib
+
+AGENT_PORT = 8765
+# Seconds a client waits for a reply, see AgentClient.request for longer ones
+AGENT_TIMEOUT = 10
+X_RES = 1072
+Y_RES = 1448
+
+# Every message is a MESSAGE_HEADER (type, payload length) and its payload,
+# every reply a REPLY_HEADER (status, payload length) and its payload
+MESSAGE_HEADER = struct.Struct("<BI")
+REPLY_HEADER = struct.Struct("<BI")
+# Payload: one flags byte followed by a raw payload (see RAW_HEADER)
+MSG_FRAME = 1
+MSG_REGIONS = 2
+# Payload: u16 brightness, reply: u16 actual brightness
+MSG_SET_BACKLIGHT = 3
+# Reply: u16 actual brightness
+MSG_GET_BACKLIGHT = 4
+# Payload: u8 enable
+MSG_KEEP_ALIVE = 5
+# Payload: u8, REFRESH_FULL makes every frame a flashing full refresh
+MSG_REFRESH_MODE = 6
+MSG_PING = 7
+# Payload: FADE, reply: u16 actual brightness at the end
+MSG_FADE_BACKLIGHT = 8
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+FLAG_COMPRESSED = 1
+FLAG_PACKED = 2
+FLAG_FLASH = 4
+FLAG_INVERT = 8
+
+REFRESH_PARTIAL = 0
+REFRESH_FULL = 1
+
+# Every region in a raw payload starts with its x, y, width and height
+RAW_HEADER = struct.Struct("<HHHH")
+BRIGHTNESS = struct.Struct("<H")
+# Target brightness, duration in milliseconds, number of steps. The reply
+# only comes once the fade is done, so it can take up to MAX_FADE seconds
+FADE = struct.Struct("<HHH")
+MAX_FADE = 65.535
+
+# Same as in kindle_display.py, repeated so this file can be deployed on its own
+DISPLAY_KEEPALIVE_COMMAND = ["lipc-set-prop", "com.lab126.powerd", "preventScreenSaver"]
+BACKLIGHT_OBJECT = "/sys/devices/platform/imx-i2c.0/i2c-0/0-003c/max77696-bl.0/backlight/max77696-bl/brightness"
+ACTUAL_BRIGHTNESS_OBJECT = "/sys/devices/platform/imx-i2c.0/i2c-0/0-003c/max77696-bl.0/backlight/max77696-bl/actual_brightness"
+BACKLIGHT_DRIVER = "/sys/devices/platform/imx-i2c.0/i2c-0/0-003c/max77696-bl.0/driver/"
+BACKLIGHT_NAME = "max77696-bl.0"
+BACKLIGHT_ATTEMPTS = 3
+
+
+class AgentError(Exception):
+    pass
+
+
+def read_exact(stream, size):
+    # Read exactly size bytes, None if the stream ends first
+    data = stream.read(size)
+    if data is None or len(data) < size:
+        return None
+    return data
+
+
+def decode_regions(payload, flags):
+    # Yields (x, y, width, height, 8-bit pixels) for every region of a raw payload
+    if flags & FLAG_COMPRESSED:
+        payload = zlib.decompress(payload)
+    offset = 0
+    while offset < len(payload):
+        x, y, width, height = RAW_HEADER.unpack_from(payload, offset)
+        offset += RAW_HEADER.size
+        size = height * ((width + 1) // 2) if flags & FLAG_PACKED else width * height
+        data = payload[offset:offset + size]
+        offset += size
+        if flags & FLAG_PACKED:
+            data = unpack_4bpp(data, width, height)
+        yield x, y, width, height, data
+
+
+def unpack_4bpp(data, width, height):
+    # Inverse of process_image.pack_4bpp
+    import numpy as np
+    nibbles = np.frombuffer(data, dtype=np.uint8).reshape(height, -1)
+    pixels = np.empty((height, nibbles.shape[1] * 2), dtype=np.uint8)
+    pixels[:, 0::2] = (nibbles >> 4) * 17
+    pixels[:, 1::2] = (nibbles & 15) * 17
+    return np.ascontiguousarray(pixels[:, :width]).tobytes()
+
+
+class FBInkDisplay:
+    # The Kindle's framebuffer through FBInk, backlight and power via sysfs/lipc
+    def __init__(self):
+        from _fbink import ffi, lib
+        self.fbink = lib
+        self.config = ffi.new("FBInkConfig *")
+        self.fbfd = lib.fbink_open()
+        lib.fbink_init(self.fbfd, self.config)
+
+    def draw(self, x, y, width, height, data, flash, invert):
+        self.config.is_flashing = flash
+        self.config.is_inverted = invert
+        if self.fbink.fbink_print_raw_data(self.fbfd, data, width, height, len(data), x, y, self.config) < 0:
+            raise AgentError("fbink_print_raw_data failed")
+
+    def get_backlight(self):
+        with open(ACTUAL_BRIGHTNESS_OBJECT) as f:
+            return int(f.read())
+
+    def write_backlight(self, value):
+        with open(BACKLIGHT_OBJECT, "w") as f:
+            f.write(str(value))
+
+    def set_backlight(self, value):
+        # Write, verify and rebind the driver if the value didn't stick
+        for _ in range(BACKLIGHT_ATTEMPTS):
+            self.write_backlight(value)
+            actual = self.get_backlight()
+            if actual == value:
+                return actual
+            for action in ("bind", "unbind"):
+                with open(BACKLIGHT_DRIVER + action, "w") as f:
+                    f.write(BACKLIGHT_NAME)
+        return actual
+
+    def keep_alive(self, enable):
+        subprocess.run(DISPLAY_KEEPALIVE_COMMAND + [str(int(enable))], check=True)
+
+    def close(self):
+        self.fbink.fbink_close(self.fbfd)
+
+
+class FileDisplay:
+    # Stand-in for testing off the device: draws into a raw 8-bit grayscale
+    # file of width x height and keeps backlight and keep-alive in memory
+    def __init__(self, path, width=X_RES, height=Y_RES):
+        self.width = width
+        self.height = height
+        if not os.path.exists(path) or os.path.getsize(path) != width * height:
+            with open(path, "wb") as f:
+                f.write(bytes(width * height))
+        self.file = open(path, "r+b")
+        self.backlight = 0
+        self.keeping_alive = False
+        self.frames = 0
+
+    def draw(self, x, y, width, height, data, flash, invert):
+        if x + width > self.width or y + height > self.height:
+            raise AgentError(f"Region {width}x{height}+{x}+{y} is outside the screen")
+        if invert:
+            data = data.translate(bytes(range(255, -1, -1)))
+        for row in range(height):
+            self.file.seek((y + row) * self.width + x)
+            self.file.write(data[row * width:(row + 1) * width])
+        self.file.flush()
+        self.frames += 1
+
+    def get_backlight(self):
+        return self.backlight
+
+    def write_backlight(self, value):
+        self.backlight = value
+
+    def set_backlight(self, value):
+        self.backlight = value
+        return value
+
+    def keep_alive(self, enable):
+        self.keeping_alive = enable
+
+    def close(self):
+        self.file.close()
+
+
+class DisplayAgent:
+    def __init__(self, display):
+        self.display = display
+        self.refresh_mode = REFRESH_PARTIAL
+        self.lock = threading.Lock()
+
+    def handle(self, message_type, payload):
+        # Returns the reply payload, raises on failure
+        if message_type == MSG_FADE_BACKLIGHT:
+            # Not under the lock, frames keep being drawn while fading
+            return BRIGHTNESS.pack(self.fade_backlight(*FADE.unpack(payload)))
+        with self.lock:
+            if message_type in (MSG_FRAME, MSG_REGIONS):
+                flags = payload[0]
+                flash = message_type == MSG_FRAME and (flags & FLAG_FLASH or self.refresh_mode == REFRESH_FULL)
+                for x, y, width, height, data in decode_regions(payload[1:], flags):
+                    self.display.draw(x, y, width, height, data, bool(flash), bool(flags & FLAG_INVERT))
+                return b""
+            if message_type == MSG_SET_BACKLIGHT:
+                value = min(max(BRIGHTNESS.unpack(payload)[0], 0), 4095)
+                return BRIGHTNESS.pack(self.display.set_backlight(value))
+            if message_type == MSG_GET_BACKLIGHT:
+                return BRIGHTNESS.pack(self.display.get_backlight())
+            if message_type == MSG_KEEP_ALIVE:
+                self.display.keep_alive(bool(payload[0]))
+                return b""
+            if message_type == MSG_REFRESH_MODE:
+                self.refresh_mode = payload[0]
+                return b""
+            if message_type == MSG_PING:
+                return b""
+        raise AgentError(f"Unknown message type {message_type}")
+
+
+    def fade_backlight(self, value, duration, steps):
+        # Ramp to value over duration milliseconds, the last step is verified
+        value = min(max(value, 0), 4095)
+        steps = max(steps, 1)
+        start = self.display.get_backlight()
+        for step in range(1, steps):
+            self.display.write_backlight(start + (value - start) * step // steps)
+            time.sleep(duration / 1000 / steps)
+        return self.display.set_backlight(value)
+
+
+class AgentHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            header = read_exact(self.rfile, MESSAGE_HEADER.size)
+            if header is None:
+                return
+            message_type, length = MESSAGE_HEADER.unpack(header)
+            payload = read_exact(self.rfile, length)
+            if payload is None:
+                return
+            try:
+                status, reply = STATUS_OK, self.server.agent.handle(message_type, payload)
+            except Exception as e:
+                status, reply = STATUS_ERROR, str(e).encode("utf-8")
+            self.wfile.write(REPLY_HEADER.pack(status, len(reply)) + reply)
+
+
+class AgentServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, agent):
+        super().__init__(address, AgentHandler)
+        self.agent = agent
+
+
+class AgentClient:
+    # Client side of the protocol, one request/reply at a time
+    def __init__(self, host, port=AGENT_PORT, timeout=AGENT_TIMEOUT):
+        self.timeout = timeout
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.stream = self.sock.makefile("rb")
+        self.lock = threading.Lock()
+
+    def request(self, message_type, payload=b"", timeout=None):
+        # timeout overrides the connection's for requests that take longer
+        # to answer, like MSG_FADE_BACKLIGHT
+        with self.lock:
+            self.sock.settimeout(timeout or self.timeout)
+            try:
+                self.sock.sendall(MESSAGE_HEADER.pack(message_type, len(payload)))
+                self.sock.sendall(payload)
+                header = read_exact(self.stream, REPLY_HEADER.size)
+                if header is None:
+                    raise ConnectionError("Display agent closed the connection")
+                status, length = REPLY_HEADER.unpack(header)
+                reply = read_exact(self.stream, length)
+                if reply is None:
+                    raise ConnectionError("Display agent closed the connection")
+            finally:
+                self.sock.settimeout(self.timeout)
+        if status != STATUS_OK:
+            raise AgentError(reply.decode("utf-8"))
+        return reply
+
+    def close(self):
+        self.stream.close()
+        self.sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resident display agent for the Kindle.")
+    parser.add_argument("-p", "--port", type=int, default=AGENT_PORT, help=f"Port to listen on (default: {AGENT_PORT})")
+    parser.add_argument("--bind", default="127.0.0.1", help="Address to listen on, clients come in through an ssh tunnel (default: 127.0.0.1)")
+    parser.add_argument("--file", help="Draw into this raw grayscale file instead of the framebuffer (for testing)")
+    args = parser.parse_args()
+
+    display = FileDisplay(args.file) if args.file else FBInkDisplay()
+    server = AgentServer((args.bind, args.port), DisplayAgent(display))
+    print(f"Display agent listening on {args.bind}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        display.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import collections
+import hashlib
+import io
+import os
+import threading
+from disk_cache import read_entry, write_entry, evict
+
+CACHE_DIR = os.path.expanduser("~/.cache/kindle_display")
+MEMORY_LIMIT = 64 * 1024 * 1024
+DISK_LIMIT = 256 * 1024 * 1024
+# Bump when the processing changes so old entries are never served
+CACHE_VERSION = 1
+
+
+class FrameCache:
+    # LRU cache of encoded frames, keyed by a hash of the source file's
+    # content plus the processing options. Entries live in memory and on
+    # disk, each tier is evicted least recently used first once it grows
+    # past its size limit. Several processes may share the disk tier (batch
+    # conversion does), see disk_cache.
+    def __init__(self, directory=CACHE_DIR, memory_limit=MEMORY_LIMIT, disk_limit=DISK_LIMIT):
+        self.directory = directory
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.memory = collections.OrderedDict()
+        self.memory_size = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, source, **options):
+        # Returns None for sources that can't be hashed (already decoded images)
+        digest = hashlib.sha256()
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+        elif isinstance(source, bytes):
+            digest.update(source)
+        elif isinstance(source, io.IOBase):
+            position = source.tell()
+            digest.update(source.read())
+            source.seek(position)
+        else:
+            return None
+        digest.update(repr((CACHE_VERSION, sorted(options.items()))).encode("utf-8"))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        if key is None:
+            return None
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return data
+            data = self.read_disk(key)
+            if data is not None:
+                self.disk_hits += 1
+                self.remember(key, data)
+                return data
+            self.misses += 1
+            return None
+
+    def put(self, key, data):
+        if key is None:
+            return
+        with self.lock:
+            self.remember(key, data)
+            self.write_disk(key, data)
+
+    def remember(self, key, data):
+        # Add to the memory tier, dropping the least recently used entries
+        if key in self.memory:
+            self.memory_size -= len(self.memory.pop(key))
+        if len(data) > self.memory_limit:
+            return
+        self.memory[key] = data
+        self.memory_size += len(data)
+        while self.memory_size > self.memory_limit:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_size -= len(evicted)
+
+    def read_disk(self, key):
+        if not self.directory:
+            return None
+        return read_entry(self.path(key))
+
+    def write_disk(self, key, data):
+        if not self.directory:
+            return
+        write_entry(self.path(key), data)
+        evict(self.directory, self.disk_limit)
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "memory_entries": len(self.memory),
+            "memory_bytes": self.memory_size,
+        }
@@ -0,0 +1,82 @@
+import contextlib
+import json
+import threading
+import time
+
+# Per-frame durations that are summarized, in pipeline order. "latency" is
+# from the start of the capture until the frame is on the display
+STAT_FIELDS = ["capture", "process", "encode", "send", "latency"]
+# Frames the rolling percentiles and FPS are computed over
+ROLLING_WINDOW = 300
+PERCENTILES = [50, 95, 99]
+
+
+@contextlib.contextmanager
+def timed(timings, stage):
+    # Add the time spent in the block to timings[stage], if timings isn't None
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+def percentile(values, percent):
+    # Nearest-rank percentile of a sorted list
+    index = max(0, -(-len(values) * percent // 100) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+class FrameStats:
+    # Collects per-frame timings (see STAT_FIELDS), bytes sent and full
+    # refreshes. Prints rolling percentiles and FPS every interval seconds
+    # (never with interval 0) and, with path set, appends every frame as a
+    # JSON line for offline analysis. Safe to share between threads
+    def __init__(self, interval=10.0, path=None, window=ROLLING_WINDOW):
+        self.interval = interval
+        self.frames = []
+        self.window = window
+        self.count = 0
+        self.full_refreshes = 0
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.file = open(path, "a") if path else None
+        self.lock = threading.Lock()
+
+    def record(self, **frame):
+        # frame holds the stage durations in seconds plus anything else worth
+        # logging, e.g. bytes, full_refresh, regions or server
+        frame["time"] = time.time()
+        with self.lock:
+            self.count += 1
+            self.full_refreshes += bool(frame.get("full_refresh"))
+            self.frames.append((time.monotonic(), frame))
+            del self.frames[:-self.window]
+            if self.file is not None:
+                self.file.write(json.dumps(frame) + "\n")
+                self.file.flush()
+            if self.interval and time.monotonic() - self.last_report >= self.interval:
+                self.last_report = time.monotonic()
+                print("stats: " + self.summary())
+
+    def summary(self):
+        if not self.frames:
+            return "no frames"
+        first, last = self.frames[0][0], self.frames[-1][0]
+        fps = (len(self.frames) - 1) / (last - first) if last > first else 0.0
+        parts = [f"{fps:.1f} fps"]
+        sent = [frame["bytes"] for _, frame in self.frames if "bytes" in frame]
+        if sent:
+            parts.append(f"{sum(sent) / len(sent) / 1024:.0f} KB/frame")
+        parts.append(f"{self.full_refreshes}/{self.count} full refreshes")
+        for field in STAT_FIELDS:
+            values = sorted(frame[field] for _, frame in self.frames if field in frame)
+            if values:
+                parts.append(f"{field} " + "/".join(f"{percentile(values, p) * 1000:.0f}" for p in PERCENTILES) + "ms")
+        return ", ".join(parts) + " (p" + "/p".join(str(p) for p in PERCENTILES) + ")"
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
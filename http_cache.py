@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import threading
+from disk_cache import read_entry, write_entry, evict
+
+# Relative to the working directory, like the other state rss_to_epub.py keeps
+HTTP_CACHE_DIR = "http_cache"
+HTTP_CACHE_LIMIT = 50 * 1024 * 1024
+
+
+class HttpCache:
+    # Responses kept on disk across runs with their ETag and Last-Modified
+    # validators, so the next request for the same URL can be conditional
+    # and a 304 Not Modified answer costs no download. Every entry is a body
+    # file and a small JSON file with the validators. The least recently
+    # used entries are evicted once the bodies grow past the size limit.
+    def __init__(self, directory=HTTP_CACHE_DIR, limit=HTTP_CACHE_LIMIT):
+        self.directory = directory
+        self.limit = limit
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.bytes_downloaded = 0
+        self.bytes_saved = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, url, suffix):
+        return os.path.join(self.directory, hashlib.sha256(url.encode("utf-8")).hexdigest() + suffix)
+
+    def read_meta(self, url):
+        try:
+            with open(self.path(url, ".json")) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # The body may have been evicted on its own
+        return meta if meta.get("url") == url and os.path.exists(self.path(url, ".body")) else None
+
+    def validators(self, url):
+        # Headers that make a request for url conditional, empty if it isn't cached
+        meta = self.read_meta(url)
+        headers = {}
+        if meta is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def not_modified(self, url):
+        # Record a 304 for url. Returns the cached body, None if it's gone
+        content = read_entry(self.path(url, ".body"))
+        if content is None:
+            return None
+        with self.lock:
+            self.hits += 1
+            self.bytes_saved += len(content)
+        return content
+
+    def store(self, url, headers, content, defer=False):
+        # Remember a 200 response. With defer, it is only written by commit(),
+        # for responses that shouldn't count as seen unless the run finishes
+        with self.lock:
+            self.misses += 1
+            self.bytes_downloaded += len(content)
+        if not headers.get("ETag") and not headers.get("Last-Modified"):
+            return
+        meta = {"url": url, "etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified")}
+        if defer:
+            with self.lock:
+                self.pending[url] = (meta, content)
+            return
+        self.write(url, meta, content)
+
+    def write(self, url, meta, content):
+        # The validators go away first and come back last, so they never
+        # describe another version of the body
+        try:
+            os.remove(self.path(url, ".json"))
+        except FileNotFoundError:
+            pass
+        write_entry(self.path(url, ".body"), content)
+        write_entry(self.path(url, ".json"), json.dumps(meta).encode("utf-8"))
+        self.evict()
+
+    def commit(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for url, (meta, content) in pending.items():
+            self.write(url, meta, content)
+
+    def evict(self):
+        with self.lock:
+            evict(self.directory, self.limit, ".body", [".json"])
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "bytes_downloaded": self.bytes_downloaded,
+            "bytes_saved": self.bytes_saved,
+        }
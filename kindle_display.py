@@ -1,141 +1,560 @@
-from PIL import Image
+from display_agent import AgentClient, RAW_HEADER, BRIGHTNESS, FADE, MAX_FADE, AGENT_PORT, AGENT_TIMEOUT
+from display_agent import MSG_FRAME, MSG_REGIONS, MSG_SET_BACKLIGHT, MSG_GET_BACKLIGHT, MSG_KEEP_ALIVE, MSG_FADE_BACKLIGHT, MSG_PING
+from display_agent import FLAG_COMPRESSED, FLAG_PACKED, FLAG_FLASH, FLAG_INVERT
+from frame_cache import FrameCache, CACHE_DIR
+from frame_stats import FrameStats, timed
+from process_image import get_pipeline, quantize_image, pack_4bpp, DITHER_MODES, X_RES, Y_RES
+from concurrent.futures import ThreadPoolExecutor, wait
+import functools
+import io
 import os
+import shlex
+import socket
 import subprocess
 import argparse
+import tarfile
+import threading
 import time
+import uuid
+import zlib
 
-X_RES = 1072
-Y_RES = 1448
 DISPLAY_COMMAND = "eips -g {}" 
-OUTPUT_FILENAME = "display.png"
+REGION_FILENAME = "region_{}.png"
+# tmpfs on the Kindle, frames are written here instead of to the flash storage
+REMOTE_TMP_DIR = "/tmp"
 DISPLAY_KEEPALIVE_ENABLE_COMMAND = "lipc-set-prop com.lab126.powerd preventScreenSaver 1"
 DISPLAY_KEEPALIVE_DISABLE_COMMAND = "lipc-set-prop com.lab126.powerd preventScreenSaver 0"
 BACKLIGHT_OBJECT = "/sys/devices/platform/imx-i2c.0/i2c-0/0-003c/max77696-bl.0/backlight/max77696-bl/brightness"
 ACTUAL_BRIGHTNESS_OBJECT = "/sys/devices/platform/imx-i2c.0/i2c-0/0-003c/max77696-bl.0/backlight/max77696-bl/actual_brightness"
 BACKLIGHT_DRIVER = "/sys/devices/platform/imx-i2c.0/i2c-0/0-003c/max77696-bl.0/driver/"
 BACKLIGHT_NAME = "max77696-bl.0"
+# Writes before giving up on a backlight value that doesn't stick
+BACKLIGHT_ATTEMPTS = 3
+# Fades are stepped on the Kindle itself, this many times per second
+FADE_STEPS_PER_SECOND = 20
+# Control sockets for the multiplexed ssh sessions, one per Kindle. Kept at
+# a short fixed path: socket paths are limited to 104 bytes on macOS, where
+# the per-user temporary directory alone takes up about half of that
+SSH_CONTROL_DIR = f"/tmp/kindle_display_ssh_{os.getuid()}"
+# How long an idle master connection is kept around after the last command
+SSH_CONTROL_PERSIST = "10m"
+# ssh exits with 255 when the connection itself failed (as opposed to the remote command)
+SSH_CONNECTION_ERROR = 255
+SSH_RECONNECT_ATTEMPTS = 2
+# Seconds to wait for a Kindle to answer, an offline one is given up on
+# after this instead of holding up the others
+SSH_CONNECT_TIMEOUT = 5
+DEVICE_TIMEOUT = 30
+# How frames are sent: "png" is decoded and drawn by eips, "raw" is 8-bit
+# grayscale written straight to the framebuffer by FBInk and "zlib" is raw
+# compressed for slower links. LZ4 would need a module the Kindle doesn't have.
+# The "4" variants pack two 16-level pixels per byte, see quantize_image
+TRANSFER_FORMATS = ["png", "raw", "zlib", "raw4", "zlib4"]
+ZLIB_LEVEL = 1
+REMOTE_PYTHON = "python3"
+# Runs on the Kindle: unpacks a raw payload from stdin and draws each region
+# with the FBInk Python bindings. Arguments are the compress, 4bpp, flash and invert flags
+FBINK_RAW_SCRIPT = """
+import struct, sys, zlib
+from _fbink import ffi, lib as fbink
+compressed, packed, flashing, inverted = (int(arg) for arg in sys.argv[1:5])
+payload = sys.stdin.buffer.read()
+if compressed:
+    payload = zlib.decompress(payload)
+if packed:
+    import numpy as np
+config = ffi.new("FBInkConfig *")
+config.is_flashing = flashing
+config.is_inverted = inverted
+fbfd = fbink.fbink_open()
+fbink.fbink_init(fbfd, config)
+header = struct.Struct("<HHHH")
+offset = 0
+while offset < len(payload):
+    x, y, w, h = header.unpack_from(payload, offset)
+    offset += header.size
+    size = h * ((w + 1) // 2) if packed else w * h
+    data = payload[offset:offset + size]
+    offset += size
+    if packed:
+        nibbles = np.frombuffer(data, dtype=np.uint8).reshape(h, -1)
+        pixels = np.empty((h, nibbles.shape[1] * 2), dtype=np.uint8)
+        pixels[:, 0::2] = (nibbles >> 4) * 17
+        pixels[:, 1::2] = (nibbles & 15) * 17
+        data = np.ascontiguousarray(pixels[:, :w]).tobytes()
+    fbink.fbink_print_raw_data(fbfd, data, w, h, len(data), x, y, config)
+fbink.fbink_close(fbfd)
+"""
+
+
+class KindleConnection:
+    # A reusable connection to one Kindle. Every command goes through a single
+    # OpenSSH ControlMaster session, so only the first call pays for the TCP
+    # connect and key exchange; ssh calls after that are multiplexed
+    # over the already open socket. A dropped master is torn down and
+    # re-established transparently on the next command.
+    #
+    # With agent_port set, frames, backlight and keep-alive go to the resident
+    # display agent (display_agent.py) instead, through a port forward on the
+    # same ssh session, or straight to agent_host if given. If the agent
+    # can't be reached, everything falls back to ssh commands.
+    def __init__(self, server, persist=SSH_CONTROL_PERSIST, agent_port=None, agent_host=None):
+        self.server = server
+        self.persist = persist
+        self.agent_port = agent_port
+        self.agent_host = agent_host
+        self.agent = None
+        self.agent_failed = False
+        # Last known backlight brightness, None until it was read or set
+        self.backlight = None
+        os.makedirs(SSH_CONTROL_DIR, mode=0o700, exist_ok=True)
+        os.chmod(SSH_CONTROL_DIR, 0o700)
+        # %C is a hash of the connection parameters, keeps the socket path short
+        self.control_path = os.path.join(SSH_CONTROL_DIR, "%C")
+
+    def ssh_options(self):
+        return [
+            "-o", "ControlMaster=auto",
+            "-o", "ControlPath=" + self.control_path,
+            "-o", "ControlPersist=" + self.persist,
+            "-o", "ServerAliveInterval=5",
+            "-o", "ServerAliveCountMax=2",
+            "-o", f"ConnectTimeout={SSH_CONNECT_TIMEOUT}",
+        ]
+
+    def _run(self, args, input=None, capture=False, check=True):
+        for attempt in range(SSH_RECONNECT_ATTEMPTS + 1):
+            result = subprocess.run(args, input=input, capture_output=capture)
+            if result.returncode != SSH_CONNECTION_ERROR or attempt == SSH_RECONNECT_ATTEMPTS:
+                break
+            print(f"Connection to {self.server} failed, reconnecting...")
+            self.close()
+        if check and result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode, args, result.stdout, result.stderr)
+        return result
+
+    def run(self, command, input=None, capture=False, check=True):
+        # Run a shell command on the Kindle
+        return self._run(["ssh"] + self.ssh_options() + [self.server, command], input, capture, check)
+
+    def connect(self):
+        # Open the master session up front so the first frame doesn't pay for it
+        self.run("true")
+        return self
+
+    def close(self):
+        # Stop the master session (if any), the next command will open a new one
+        self.close_agent()
+        subprocess.run(["ssh", "-o", "ControlPath=" + self.control_path, "-O", "exit", self.server],
+                       capture_output=True)
+
+    def forward_agent_port(self):
+        # Forward a free local port to the agent on the Kindle's loopback
+        # through the master session, returns the local port
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            local_port = probe.getsockname()[1]
+        self.connect()
+        self._run(["ssh", "-o", "ControlPath=" + self.control_path, "-O", "forward",
+                   "-L", f"127.0.0.1:{local_port}:127.0.0.1:{self.agent_port}", self.server], capture=True)
+        return local_port
+
+    def get_agent(self):
+        # The display agent client, or None if it's disabled or unreachable
+        if self.agent_port is None or self.agent_failed:
+            return None
+        if self.agent is None:
+            try:
+                if self.agent_host:
+                    self.agent = AgentClient(self.agent_host, self.agent_port)
+                else:
+                    self.agent = AgentClient("127.0.0.1", self.forward_agent_port())
+            except (OSError, subprocess.CalledProcessError) as e:
+                print(f"Display agent on {self.server} not available ({e}), using ssh")
+                self.agent_failed = True
+                return None
+        return self.agent
+
+    def agent_request(self, message_type, payload=b"", timeout=None):
+        # Returns the agent's reply, or None if the caller should use ssh instead
+        agent = self.get_agent()
+        if agent is None:
+            return None
+        try:
+            return agent.request(message_type, payload, timeout)
+        except OSError as e:
+            print(f"Lost the display agent on {self.server} ({e}), using ssh")
+            self.close_agent()
+            self.agent_failed = True
+            return None
+
+    def close_agent(self):
+        if self.agent is not None:
+            self.agent.close()
+            self.agent = None
+
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def get_connection(server, agent_port=None):
+    # Accept either an existing connection or an ssh server string
+    if isinstance(server, KindleConnection):
+        return server
+    with _connections_lock:
+        if server not in _connections:
+            _connections[server] = KindleConnection(server, agent_port=agent_port)
+        elif agent_port is not None:
+            _connections[server].agent_port = agent_port
+        return _connections[server]
+
+
+def close_connections():
+    with _connections_lock:
+        for connection in _connections.values():
+            connection.close()
+        _connections.clear()
 
 
 def backlight_hotfix(server):
+    connection = get_connection(server)
     bind_command = "echo -n " + BACKLIGHT_NAME + " > " + BACKLIGHT_DRIVER + "bind"
     unbind_command = "echo -n " + BACKLIGHT_NAME + " > " + BACKLIGHT_DRIVER + "unbind"
-    subprocess.run("ssh " + server + " " + '"' + bind_command + '"', shell=True, check=True)
-    subprocess.run("ssh " + server + " " + '"' + unbind_command + '"', shell=True, check=True)
-
-
-def set_backlight(val, server):
-    # val should be between 0 and 4095
+    connection.run(bind_command)
+    connection.run(unbind_command)
+
+
+def backlight_command(val):
+    # Shell command that writes val, reads it back and applies the hotfix
+    # until it sticks, at most BACKLIGHT_ATTEMPTS writes, all in one round
+    # trip. Prints the actual brightness
+    return (f"i=1; while :; do echo {val} > {BACKLIGHT_OBJECT}; actual=$(cat {ACTUAL_BRIGHTNESS_OBJECT}); "
+            f"if [ \"$actual\" = {val} ] || [ $i -ge {BACKLIGHT_ATTEMPTS} ]; then break; fi; "
+            f"echo -n {BACKLIGHT_NAME} > {BACKLIGHT_DRIVER}bind; echo -n {BACKLIGHT_NAME} > {BACKLIGHT_DRIVER}unbind; "
+            f"i=$((i + 1)); done; echo $actual")
+
+
+def fade_command(val, steps, step_time):
+    # Shell command that ramps the brightness from its current value to val
+    # in steps, step_time seconds apart, then sets val as backlight_command does
+    return (f"start=$(cat {ACTUAL_BRIGHTNESS_OBJECT}); i=1; while [ $i -lt {steps} ]; do "
+            f"echo $((start + ({val} - start) * i / {steps})) > {BACKLIGHT_OBJECT}; usleep {int(step_time * 1000000)}; "
+            f"i=$((i + 1)); done; " + backlight_command(val))
+
+
+def fade_seconds(text):
+    # argparse type for --fade, the agent's protocol has room for MAX_FADE seconds
+    fade = float(text)
+    if not 0 <= fade <= MAX_FADE:
+        raise argparse.ArgumentTypeError(f"fades take between 0 and {MAX_FADE} seconds")
+    return fade
+
+
+def default_format(transfer_format, agent):
+    # --format defaults to raw with --agent, the agent can't draw PNGs
+    if transfer_format is None:
+        return "raw" if agent else "png"
+    if transfer_format == "png" and agent:
+        print("png frames are drawn by eips over ssh, not by the display agent; use raw or zlib to send them to it")
+    return transfer_format
+
+
+def set_backlight(val, server, fade=0):
+    # val should be between 0 and 4095. With fade, the brightness is ramped
+    # there over that many seconds, at most MAX_FADE. Returns the actual
+    # brightness. A value that is already set according to the cache isn't
+    # written again
+    if not 0 <= fade <= MAX_FADE:
+        raise ValueError(f"Fades take between 0 and {MAX_FADE} seconds, not {fade}")
     if val < 0:
         val = 0
     elif val > 4095:
         val = 4095
-    subprocess.run("ssh " + server + ' "'+ " echo " + str(val) + " > " + BACKLIGHT_OBJECT + '"', shell=True, check=True)
-    if get_actual_backlight(server) != val:
-        print("Backlight brightness not set correctly, hotfixing...")
-        backlight_hotfix(server)
-        set_backlight(val, server)
+    connection = get_connection(server)
+    if connection.backlight == val:
+        return val
+    steps = max(1, int(fade * FADE_STEPS_PER_SECOND))
+    # The agent writes, verifies and hotfixes on the device in one request
+    if fade:
+        # The agent only replies once the fade is done
+        reply = connection.agent_request(MSG_FADE_BACKLIGHT, FADE.pack(val, int(fade * 1000), steps), timeout=fade + AGENT_TIMEOUT)
+    else:
+        reply = connection.agent_request(MSG_SET_BACKLIGHT, BRIGHTNESS.pack(val))
+    if reply is not None:
+        actual = BRIGHTNESS.unpack(reply)[0]
+    else:
+        command = fade_command(val, steps, fade / steps) if fade else backlight_command(val)
+        actual = int(connection.run(command, capture=True).stdout.decode("utf-8"))
+    connection.backlight = actual
+    if actual != val:
+        print(f"Backlight brightness not set correctly after {BACKLIGHT_ATTEMPTS} attempts ({actual} instead of {val})")
+    return actual
 
 def get_actual_backlight(server):
-    return int(subprocess.run("ssh " + server + ' "'+ " cat " + ACTUAL_BRIGHTNESS_OBJECT + '"', shell=True, check=True, capture_output=True).stdout.decode("utf-8"))
+    connection = get_connection(server)
+    reply = connection.agent_request(MSG_GET_BACKLIGHT)
+    if reply is not None:
+        connection.backlight = BRIGHTNESS.unpack(reply)[0]
+    else:
+        connection.backlight = int(connection.run("cat " + ACTUAL_BRIGHTNESS_OBJECT, capture=True).stdout.decode("utf-8"))
+    return connection.backlight
 
 def get_backlight(server):
-    return int(subprocess.run("ssh " + server + ' "'+ " cat " + BACKLIGHT_OBJECT + '"', shell=True, check=True, capture_output=True).stdout.decode("utf-8"))
+    return int(get_connection(server).run("cat " + BACKLIGHT_OBJECT, capture=True).stdout.decode("utf-8"))
+
+def ping(server):
+    # Round trip time to the Kindle in seconds, through the agent if there is
+    # one, otherwise an empty command over the shared ssh session
+    connection = get_connection(server)
+    start = time.perf_counter()
+    if connection.agent_request(MSG_PING) is None:
+        connection.run("true")
+    return time.perf_counter() - start
 
 def keep_alive(enable, server):
+    if get_connection(server).agent_request(MSG_KEEP_ALIVE, bytes([enable])) is not None:
+        return
     if enable:
-        subprocess.run("ssh " + server + " "  + ' "'+ DISPLAY_KEEPALIVE_ENABLE_COMMAND + '"', shell=True, check=True)
+        get_connection(server).run(DISPLAY_KEEPALIVE_ENABLE_COMMAND)
     else:
-        subprocess.run("ssh " + server + " " + ' "'+ DISPLAY_KEEPALIVE_DISABLE_COMMAND + '"', shell=True, check=True)
-
-
-def process_image(input_path, crop=False, rotation=0):
-    with Image.open(input_path) as img:
-        # Rotate image if needed
-        if rotation:
-            img = img.rotate(rotation * 90, expand=True)
-
-        # Get original image size
-        orig_width, orig_height = img.size
-
-        # Calculate aspect ratios
-        target_ratio = X_RES / Y_RES
-        img_ratio = orig_width / orig_height
-
-        if crop:
-            # Crop to screen (fill entire screen, centered crop)
-            if img_ratio > target_ratio:
-                # Image is wider, scale to match height
-                new_height = Y_RES
-                new_width = int(new_height * img_ratio)
-            else:
-                # Image is taller, scale to match width
-                new_width = X_RES
-                new_height = int(new_width / img_ratio)
-
-            # Resize the image
-            img = img.resize((new_width, new_height), Image.LANCZOS)
-
-            # Calculate the crop box
-            left = (new_width - X_RES) // 2
-            top = (new_height - Y_RES) // 2
-            right = left + X_RES
-            bottom = top + Y_RES
-
-            # Crop the image
-            img = img.crop((left, top, right, bottom))
-        else:
-            # Fit to screen (maintain aspect ratio, no cropping)
-            if img_ratio > target_ratio:
-                # Image is wider, scale to match width
-                new_width = X_RES
-                new_height = int(X_RES / img_ratio)
-            else:
-                # Image is taller, scale to match height
-                new_height = Y_RES
-                new_width = int(Y_RES * img_ratio)
-
-            # Resize the image
-            img = img.resize((new_width, new_height), Image.LANCZOS)
-
-        # Create a black background
-        background = Image.new('RGB', (X_RES, Y_RES), (0, 0, 0))
-
-        # Paste the processed image onto the center of the black background
-        offset = ((X_RES - img.width) // 2, (Y_RES - img.height) // 2)
-        background.paste(img, offset)
-        img = background
-
-        
-
-        # convert to grayscale
-        img = img.convert('L')
-
-        # Return the processed image
-        return img
-
-
-def display_image(input_path, ssh_server, crop=False, rotation=0, negative=False, force_refresh=True):
-    # Process the image for the kindle display
-    img = process_image(input_path, crop, rotation)
-
-    # Save the processed image
-    img.save(OUTPUT_FILENAME, 'PNG')
-
-    # SCP the image to the Kindle
-    scp_command = f"scp {OUTPUT_FILENAME} {ssh_server}:~/{OUTPUT_FILENAME}"
-    subprocess.run(scp_command, shell=True, check=True)
-
-    # SSH into the Kindle and run the display command
-    ssh_command = f"ssh {ssh_server} '{DISPLAY_COMMAND.format(OUTPUT_FILENAME + (" -v" if negative else "") + (" -f" if force_refresh else ""))}'"
-    subprocess.run(ssh_command, shell=True, check=True)
-
-    # Clean up the local processed image
-    os.remove(OUTPUT_FILENAME)
+        get_connection(server).run(DISPLAY_KEEPALIVE_DISABLE_COMMAND)
+
+
+def encode_image(img, transfer_format="png"):
+    # Encode the processed image in memory, nothing touches the local disk
+    if transfer_format != "png":
+        return encode_raw(img, [(0, 0, img.width, img.height)], transfer_format)
+    buffer = io.BytesIO()
+    img.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def encode_raw(img, boxes, transfer_format="raw"):
+    # Raw grayscale payload for FBINK_RAW_SCRIPT, a RAW_HEADER followed by
+    # the pixels for every (left, top, right, bottom) box
+    parts = []
+    for box in boxes:
+        left, top, right, bottom = box
+        region = img if box == (0, 0, img.width, img.height) else img.crop(box)
+        parts.append(RAW_HEADER.pack(left, top, right - left, bottom - top))
+        parts.append(pack_4bpp(region) if transfer_format.endswith("4") else region.tobytes())
+    payload = b"".join(parts)
+    if transfer_format.startswith("zlib"):
+        payload = zlib.compress(payload, ZLIB_LEVEL)
+    return payload
+
+
+def remote_tmp_path(suffix=""):
+    # A unique path in the Kindle's tmpfs so concurrent calls don't clash
+    return f"{REMOTE_TMP_DIR}/kindle_display_{uuid.uuid4().hex}{suffix}"
+
+
+def raw_flags(transfer_format, force_refresh, negative):
+    return [transfer_format.startswith("zlib"), transfer_format.endswith("4"), force_refresh, negative]
+
+
+def raw_command(transfer_format, force_refresh, negative):
+    # Command that draws a raw payload from stdin with FBINK_RAW_SCRIPT
+    flags = raw_flags(transfer_format, force_refresh, negative)
+    return f"{REMOTE_PYTHON} -c {shlex.quote(FBINK_RAW_SCRIPT)} " + " ".join(str(int(flag)) for flag in flags)
+
+
+def send_to_agent(connection, message_type, data, transfer_format, force_refresh, negative):
+    # Hand a raw payload to the display agent, False if it isn't available
+    bits = [FLAG_COMPRESSED, FLAG_PACKED, FLAG_FLASH, FLAG_INVERT]
+    flags = sum(bit for bit, flag in zip(bits, raw_flags(transfer_format, force_refresh, negative)) if flag)
+    return connection.agent_request(message_type, bytes([flags]) + data) is not None
+
+
+def send_raw(img, boxes, ssh_server, negative=False, force_refresh=False, transfer_format="raw", timings=None):
+    # Pipe raw pixels into FBInk on the Kindle, skipping the PNG encode here
+    # and the PNG decode on the device
+    connection = get_connection(ssh_server)
+    with timed(timings, "encode"):
+        data = encode_raw(img, boxes, transfer_format)
+    with timed(timings, "send"):
+        if not send_to_agent(connection, MSG_REGIONS, data, transfer_format, force_refresh, negative):
+            connection.run(raw_command(transfer_format, force_refresh, negative), input=data)
+    return len(data)
+
+
+def send_image(img, ssh_server, negative=False, force_refresh=True, transfer_format="png", timings=None):
+    # Returns the number of bytes sent. With a timings dict, the seconds spent
+    # encoding and sending (transfer plus drawing) are added to it
+    with timed(timings, "encode"):
+        data = encode_image(img, transfer_format)
+    with timed(timings, "send"):
+        return send_encoded(data, ssh_server, negative, force_refresh, transfer_format)
+
+
+def send_encoded(data, ssh_server, negative=False, force_refresh=True, transfer_format="png"):
+    # Display a full frame that was already encoded by encode_image
+    connection = get_connection(ssh_server)
+    if transfer_format != "png":
+        if not send_to_agent(connection, MSG_FRAME, data, transfer_format, force_refresh, negative):
+            connection.run(raw_command(transfer_format, force_refresh, negative), input=data)
+        return len(data)
+
+    # Stream the encoded image into tmpfs on the Kindle and display it, all
+    # in one command over the shared session
+    remote_path = remote_tmp_path(".png")
+    options = remote_path + (" -v" if negative else "") + (" -f" if force_refresh else "")
+    command = f"cat > {remote_path} && {DISPLAY_COMMAND.format(options)}; status=$?; rm -f {remote_path}; exit $status"
+    connection.run(command, input=data)
+    return len(data)
+
+
+def send_regions(img, regions, ssh_server, negative=False, transfer_format="png", timings=None):
+    # Draw only the given (left, top, right, bottom) boxes of img at their
+    # offsets. Returns the number of bytes sent
+    if transfer_format != "png":
+        return send_raw(img, regions, ssh_server, negative, False, transfer_format, timings)
+
+    # The PNG crops travel as one in-memory tar stream that is unpacked into
+    # tmpfs on the Kindle and drawn by a single command
+    buffer = io.BytesIO()
+    commands = []
+    remote_dir = remote_tmp_path()
+    with timed(timings, "encode"), tarfile.open(fileobj=buffer, mode='w') as tar:
+        for i, (left, top, right, bottom) in enumerate(regions):
+            data = encode_image(img.crop((left, top, right, bottom)))
+            info = tarfile.TarInfo(REGION_FILENAME.format(i))
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+            filename = f"{remote_dir}/{info.name}"
+            commands.append(DISPLAY_COMMAND.format(f"{filename} -x {left} -y {top}" + (" -v" if negative else "")))
+
+    command = f"mkdir -p {remote_dir} && tar -x -C {remote_dir} && {' && '.join(commands)}; status=$?; rm -rf {remote_dir}; exit $status"
+    data = buffer.getvalue()
+    with timed(timings, "send"):
+        get_connection(ssh_server).run(command, input=data)
+    return len(data)
+
+
+def prepare_frame(input_path, crop=False, rotation=0, transfer_format="png", dither=None, cache=None, size=(X_RES, Y_RES), timings=None):
+    # Process and encode input_path for a screen of the given size. With a
+    # FrameCache, a source that was prepared with the same options before is
+    # returned straight from the cache without decoding or encoding.
+    # negative isn't part of the key, it is applied on the Kindle
+    key = None
+    data = None
+    if cache is not None:
+        key = cache.key(input_path, crop=crop, rotation=rotation, dither=dither, transfer_format=transfer_format, size=size)
+        data = cache.get(key)
+
+    if data is None:
+        # Process the image for the kindle display
+        with timed(timings, "process"):
+            img = get_pipeline(size).process(input_path, crop, rotation)
+            if dither:
+                img = quantize_image(img, dither)
+        with timed(timings, "encode"):
+            data = encode_image(img, transfer_format)
+        if cache is not None:
+            cache.put(key, data)
+    return data
+
+
+def send_timed(data, server, stats, timings, negative=False, force_refresh=True, transfer_format="png"):
+    # send_encoded that records the frame in a FrameStats, if given
+    timings = dict(timings)
+    with timed(timings, "send"):
+        send_encoded(data, server, negative, force_refresh, transfer_format)
+    if stats is not None:
+        server = server.server if isinstance(server, KindleConnection) else server
+        stats.record(bytes=len(data), full_refresh=force_refresh, server=server, **timings)
+
+
+def display_image(input_path, ssh_server, crop=False, rotation=0, negative=False, force_refresh=True, transfer_format="png", dither=None, cache=None, stats=None):
+    # With a FrameStats, the process, encode and send times are recorded
+    timings = {}
+    data = prepare_frame(input_path, crop, rotation, transfer_format, dither, cache, timings=timings)
+    send_timed(data, ssh_server, stats, timings, negative, force_refresh, transfer_format)
+
+
+def parse_target(spec, rotation=0):
+    # A target is "server[:rotation[:WIDTHxHEIGHT]]", e.g. root@192.168.0.2:1
+    # for a Kindle mounted sideways or root@192.168.0.3:0:758x1024 for an
+    # older model. Returns (server, rotation, (width, height))
+    server, _, rest = spec.partition(":")
+    target_rotation, _, resolution = rest.partition(":")
+    size = (X_RES, Y_RES)
+    if resolution:
+        width, _, height = resolution.lower().partition("x")
+        size = (int(width), int(height))
+    return server, int(target_rotation) if target_rotation else rotation, size
+
+
+def group_targets(targets, rotation=0):
+    # Targets that show the same pixels share a frame: returns
+    # {(rotation, size): [servers]} in the order the targets were given
+    groups = {}
+    for spec in targets:
+        server, target_rotation, size = parse_target(spec, rotation)
+        groups.setdefault((target_rotation, size), []).append(server)
+    return groups
+
+
+def run_on_targets(function, servers, timeout=DEVICE_TIMEOUT):
+    # Call function(server) for every server concurrently and wait at most
+    # timeout seconds, so one slow or offline Kindle can't hold up the rest.
+    # Returns {server: exception} for the ones that failed or didn't finish
+    if not servers:
+        return {}
+    executor = ThreadPoolExecutor(max_workers=len(servers))
+    futures = {executor.submit(function, server): server for server in servers}
+    done, pending = wait(futures, timeout=timeout)
+    # Don't wait for stragglers, their ssh commands time out on their own
+    executor.shutdown(wait=False)
+    failures = {futures[future]: future.exception() for future in done if future.exception() is not None}
+    for future in pending:
+        failures[futures[future]] = TimeoutError(f"No answer within {timeout} seconds")
+    return failures
+
+
+def display_on_targets(input_path, targets, crop=False, rotation=0, negative=False, force_refresh=True, transfer_format="png", dither=None, cache=None, timeout=DEVICE_TIMEOUT, stats=None):
+    # Display input_path on several Kindles at once. The image is processed
+    # and encoded once per (rotation, resolution) group and the encoded frame
+    # is pushed to every Kindle in the group in parallel.
+    # Returns {server: exception} for the Kindles that failed
+    failures = {}
+    for (target_rotation, size), servers in group_targets(targets, rotation).items():
+        timings = {}
+        data = prepare_frame(input_path, crop, target_rotation, transfer_format, dither, cache, size, timings)
+        send = functools.partial(send_timed, data, stats=stats, timings=timings, negative=negative, force_refresh=force_refresh, transfer_format=transfer_format)
+        failures.update(run_on_targets(send, servers, timeout))
+    return failures
+
+
+def benchmark_formats(img, ssh_server, repeats=3):
+    # Time every transfer format for img over this link and print a report.
+    # "device" is transfer plus drawing, i.e. the full send minus the encode
+    results = {}
+    for transfer_format in TRANSFER_FORMATS:
+        encode_times = []
+        send_times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            size = len(encode_image(img, transfer_format))
+            encode_times.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            send_image(img, ssh_server, force_refresh=False, transfer_format=transfer_format)
+            send_times.append(time.perf_counter() - start)
+        encode_time = sorted(encode_times)[len(encode_times) // 2]
+        send_time = sorted(send_times)[len(send_times) // 2]
+        results[transfer_format] = {"bytes": size, "encode": encode_time, "device": send_time - encode_time, "total": send_time}
+
+    print(f"{'format':<8}{'bytes':>10}{'encode ms':>12}{'device ms':>12}{'total ms':>12}")
+    for transfer_format, result in results.items():
+        print(f"{transfer_format:<8}{result['bytes']:>10}{result['encode'] * 1000:>12.1f}{result['device'] * 1000:>12.1f}{result['total'] * 1000:>12.1f}")
+    print("Fastest: " + min(results, key=lambda f: results[f]["total"]))
+    return results
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process and display an image on Kindle.")
     parser.add_argument("input_image", help="Path to the input image file")
-    parser.add_argument("ssh_server", help="SSH server address (e.g., root@192.168.0.1)")
+    parser.add_argument("ssh_server", nargs="+", help="SSH server address (e.g., root@192.168.0.1), several to display on all of them. Append :ROTATION[:WIDTHxHEIGHT] for a Kindle that is mounted differently or has another resolution")
     parser.add_argument("-c", "--crop", action="store_true", help="Crop the image to fill the screen instead of fitting to screen")
     parser.add_argument("-n", "--negative", action="store_true", help="Display the image with negative colors")
     parser.add_argument("-f", "--force-refresh", action="store_true", help="Force a refresh of the display")
@@ -143,24 +562,55 @@ if __name__ == "__main__":
     parser.add_argument("-r", "--rotate", type=int, choices=[0, 1, 2, 3], default=0, help="Rotate the image (0: no rotation, 1: 90 degrees CW, 2: 180 degrees, 3: 270 degrees CW)")
     # argument for bnacklight, values from 0 to 4095
     parser.add_argument("-b", "--backlight", type=int, default=-1, help="Set the backlight brightness (0 to 4095)")
+    parser.add_argument("--fade", type=fade_seconds, default=0, help=f"Fade the backlight to --backlight over this many seconds, at most {MAX_FADE}")
+    parser.add_argument("--format", choices=TRANSFER_FORMATS, default=None, help="Transfer format for the image (default: png, raw with --agent)")
+    parser.add_argument("--dither", choices=DITHER_MODES, default=None, help="Quantize to the panel's 16 gray levels with this dithering (needed for good results with raw4/zlib4)")
+    parser.add_argument("-g", "--agent", action="store_true", help="Send raw frames, backlight and keep-alive to the display agent running on the Kindle, falling back to ssh")
+    parser.add_argument("--cache", action="store_true", help="Reuse processed images from the frame cache in " + CACHE_DIR)
+    parser.add_argument("--benchmark-formats", action="store_true", help="Time every transfer format with this image and print a report")
+    parser.add_argument("--stats-file", help="Append the timings of the displayed frame(s) to this file as JSON lines")
     
 
     args = parser.parse_args()
+    args.format = default_format(args.format, args.agent)
 
-    if args.backlight != -1:
-        set_backlight(args.backlight, args.ssh_server)
+    # All commands below share one ssh session per Kindle, which stays open
+    # for SSH_CONTROL_PERSIST so repeated invocations can reuse it too
+    servers = [parse_target(spec)[0] for spec in args.ssh_server]
+    for server in servers:
+        get_connection(server, AGENT_PORT if args.agent else None)
 
-    # SSH into the Kindle and run the keep-alive command
-    if args.keep_alive:
-        keep_alive(True, args.ssh_server)
-    else:
-        keep_alive(False, args.ssh_server)
+    def setup(server):
+        if args.backlight != -1:
+            set_backlight(args.backlight, server, args.fade)
+        # SSH into the Kindle and run the keep-alive command
+        keep_alive(args.keep_alive, server)
+
+    failures = run_on_targets(setup, servers)
     
-    # backlight = get_actual_backlight(args.ssh_server)
-    # set_backlight(4095, args.ssh_server)
-    display_image(args.input_image, args.ssh_server, args.crop, args.rotate, args.negative)
+    # backlight = get_actual_backlight(connection)
+    # set_backlight(4095, connection)
+    if args.benchmark_formats:
+        server, rotation, size = parse_target(args.ssh_server[0], args.rotate)
+        img = get_pipeline(size).process(args.input_image, args.crop, rotation)
+        benchmark_formats(quantize_image(img, args.dither) if args.dither else img, server)
+    else:
+        cache = FrameCache() if args.cache else None
+        stats = FrameStats(interval=0, path=args.stats_file)
+        targets = [spec for spec in args.ssh_server if parse_target(spec)[0] not in failures]
+        failures.update(display_on_targets(args.input_image, targets, args.crop, args.rotate, args.negative, transfer_format=args.format, dither=args.dither, cache=cache, stats=stats))
+        stats.close()
+        if cache is not None:
+            print(f"Frame cache: {cache.stats()}")
+        for _, frame in stats.frames:
+            timings = ", ".join(f"{field} {frame[field] * 1000:.0f}ms" for field in ("process", "encode", "send") if field in frame)
+            print(f"{frame['server']}: {frame['bytes'] / 1024:.0f} KB, {timings}")
     
 
-    print(f"Image processed, transferred, and displayed on Kindle at {args.ssh_server}")
+    for server in servers:
+        if server in failures:
+            print(f"Failed to display on Kindle at {server}: {failures[server]}")
+        else:
+            print(f"Image processed, transferred, and displayed on Kindle at {server}")
     # time.sleep(5)
     # set_backlight(backlight, args.ssh_server)
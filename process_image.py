@@ -1,11 +1,45 @@
 
-from PIL import Image, ImageFont, ImageDraw
+from PIL import Image, ImageFont, ImageDraw, PngImagePlugin
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import argparse
+import contextlib
+import functools
+import glob
+import io
+import os
+import time
 import numpy as np
+from frame_cache import FrameCache, CACHE_DIR
+from frame_stats import timed
 
 
 X_RES = 1072
 Y_RES = 1448
+# The panel shows 16 shades of gray, anything finer is quantized by the
+# display controller itself and shows up as banding
+EINK_LEVELS = 16
+DITHER_MODES = ["none", "bayer", "floyd-steinberg"]
+# 8x8 Bayer threshold matrix, normalized to [0, 1)
+BAYER_MATRIX = np.array([
+    [0, 32, 8, 40, 2, 34, 10, 42],
+    [48, 16, 56, 24, 50, 18, 58, 26],
+    [12, 44, 4, 36, 14, 46, 6, 38],
+    [60, 28, 52, 20, 62, 30, 54, 22],
+    [3, 35, 11, 43, 1, 33, 9, 41],
+    [51, 19, 59, 27, 49, 17, 57, 25],
+    [15, 47, 7, 39, 13, 45, 5, 37],
+    [63, 31, 55, 23, 61, 29, 53, 21],
+], dtype=np.float32) / 64
+# Same direction as the rotate(rotation * 90) used before, counter-clockwise
+ROTATIONS = {1: Image.ROTATE_90, 2: Image.ROTATE_180, 3: Image.ROTATE_270}
+BANNER_HEIGHT = 100
+FONT_PATH = 'futura.ttf'
+# Downscales by more than this factor use reduce() before the LANCZOS pass
+REDUCING_GAP = 3.0
+# Files picked up from directories in batch mode
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp", ".tif", ".tiff"}
+# PNG text chunk holding the source key of a converted image
+SOURCE_KEY = "kindle-display-source"
 
 def need_rotation(input_path: str) -> bool:
     with Image.open(input_path) as img:
@@ -17,32 +51,38 @@ def need_rotation(input_path: str) -> bool:
 
 from PIL import Image, ImageDraw, ImageFont
 
-def add_banner(img, title, subtitle):
-    # Define banner dimensions
-    box_height = 100
-    box_width = img.width
-    
-     # Create an oval gradient banner for grayscale
-    banner = Image.new('L', (box_width, box_height), 0)  # Black background
-    gradient = np.zeros((box_height, box_width), dtype=np.uint8)
+# Font objects by size, loading futura.ttf is slow on the Kindle
+_fonts = {}
+
+def get_font(size):
+    font = _fonts.get(size)
+    if font is None:
+        font = _fonts[size] = ImageFont.truetype(FONT_PATH, size)
+    return font
+
+@functools.lru_cache(maxsize=8)
+def banner_gradient(box_width, box_height=BANNER_HEIGHT):
+    # Oval gradient for the banner background, brightest in the center
     center_x, center_y = box_width // 2, box_height // 2
     max_radius_x = box_width / 2  # Horizontal scaling
     max_radius_y = box_height / 2  # Vertical scaling
+    dx = (np.arange(box_width) - center_x) / max_radius_x
+    dy = (np.arange(box_height) - center_y) / max_radius_y
+    distance = np.sqrt(dx[np.newaxis, :] ** 2 + dy[:, np.newaxis] ** 2)
+    brightness = np.maximum(0, 1 - distance)
+    return Image.fromarray((brightness * 70).astype(np.uint8), mode='L')
 
-    for y in range(box_height):
-        for x in range(box_width):
-            dx = (x - center_x) / max_radius_x
-            dy = (y - center_y) / max_radius_y
-            distance = np.sqrt(dx**2 + dy**2)
-            brightness = max(0, 1 - distance)  # Brightest at center
-            gradient[y, x] = int(brightness * 70)
-    
-    banner = Image.fromarray(gradient, mode='L')
+def add_banner(img, title, subtitle):
+    # Draws the banner over the bottom of img, in place, and returns img
+    box_width = img.width
+
+    # Copy the cached gradient so the text doesn't end up in the cache
+    banner = banner_gradient(box_width).copy()
 
     # Add title and subtitle
     draw = ImageDraw.Draw(banner)
-    title_font = ImageFont.truetype('futura.ttf', 30)  # Default font
-    subtitle_font = ImageFont.truetype('futura.ttf', 20)  # Default font
+    title_font = get_font(30)
+    subtitle_font = get_font(20)
 
     # Calculate title position
     title_bbox = draw.textbbox((0, 0), title, font=title_font)
@@ -60,93 +100,343 @@ def add_banner(img, title, subtitle):
     draw.text((title_x, title_y), title, font=title_font, fill=255)  # White text
     draw.text((subtitle_x, subtitle_y), subtitle, font=subtitle_font, fill=255)
     
-    # Combine the original grayscale image with the banner
-    new_img = Image.new('L', (img.width, img.height + box_height), 0)  # Grayscale image
-    new_img.paste(img, (0, 0))
-    new_img.paste(banner, (0, img.height-100))
+    # Put the banner over the bottom of the image
+    img.paste(banner, (0, img.height - BANNER_HEIGHT))
     
-    return new_img
+    return img
 
-def process_image(input_path, crop=False, rotation=0):
-    with Image.open(input_path) as img:
-        # Rotate image if needed
-        if rotation:
-            img = img.rotate(rotation * 90, expand=True)
+def quantize_image(img, dither="bayer", levels=EINK_LEVELS):
+    # Reduce a grayscale image to the panel's gray levels. The result is
+    # still an 'L' image, with every pixel on one of the levels (0, 17, ..., 255)
+    step = 255 // (levels - 1)
+    if dither == "floyd-steinberg":
+        # Error diffusion is inherently sequential, Pillow's C implementation
+        # is much faster than anything done per pixel from Python. It only
+        # dithers when quantizing from RGB, 'L' images are mapped as is
+        palette = Image.new('P', (1, 1))
+        grays = [min(i, levels - 1) * step for i in range(256)]
+        palette.putpalette([gray for gray in grays for _ in range(3)])
+        indices = np.asarray(img.convert('RGB').quantize(palette=palette, dither=Image.FLOYDSTEINBERG))
+        return Image.fromarray(np.array(grays, dtype=np.uint8)[indices], mode='L')
+
+    scaled = np.asarray(img, dtype=np.float32) * ((levels - 1) / 255)
+    if dither == "bayer":
+        height, width = scaled.shape
+        thresholds = np.tile(BAYER_MATRIX, (-(-height // 8), -(-width // 8)))[:height, :width]
+        indices = np.floor(scaled + thresholds)
+    else:
+        indices = np.round(scaled)
+    indices = np.clip(indices, 0, levels - 1).astype(np.uint8)
+    return Image.fromarray(indices * step, mode='L')
 
-        # Get original image size
-        orig_width, orig_height = img.size
+def pack_4bpp(img):
+    # Pack a 16-level grayscale image two pixels per byte, high nibble first.
+    # Rows with an odd width are padded with a black pixel
+    levels = np.asarray(img, dtype=np.uint8) >> 4
+    if levels.shape[1] % 2:
+        levels = np.pad(levels, ((0, 0), (0, 1)))
+    return ((levels[:, 0::2] << 4) | levels[:, 1::2]).tobytes()
+
+def open_image(source):
+    # Accept a path, a file object or an already decoded image
+    if isinstance(source, Image.Image):
+        return contextlib.nullcontext(source)
+    return Image.open(source)
+
+class ImagePipeline:
+    # Fits images to the Kindle screen. The resize/crop/offset plan is worked
+    # out once per (source size, rotation, crop) and reused for every frame
+    # with that shape. Sources are decoded near the target size where the
+    # format allows it (JPEG draft mode), resized and cropped in one step in
+    # their original orientation and only rotated once they are screen-sized.
+    #
+    # size is the screen resolution, the Kindle's own by default.
+    def __init__(self, size=(X_RES, Y_RES)):
+        self.width, self.height = size
+        self.plans = {}
+
+    def plan(self, size, rotation, crop):
+        key = (size, rotation, crop)
+        plan = self.plans.get(key)
+        if plan is None:
+            plan = self.plans[key] = self.make_plan(size, rotation, crop)
+        return plan
+
+    def make_plan(self, size, rotation, crop):
+        # Returns (scaled size, resize size, source box, offset on the screen).
+        # Sizes and the box are in the source's orientation, the rotation is
+        # applied to the resized image afterwards
+        swap = rotation % 2 == 1
+        orig_width, orig_height = (size[1], size[0]) if swap else size
 
         # Calculate aspect ratios
-        target_ratio = X_RES / Y_RES
+        target_ratio = self.width / self.height
         img_ratio = orig_width / orig_height
 
         if crop:
             # Crop to screen (fill entire screen, centered crop)
             if img_ratio > target_ratio:
                 # Image is wider, scale to match height
-                new_height = Y_RES
+                new_height = self.height
                 new_width = int(new_height * img_ratio)
             else:
                 # Image is taller, scale to match width
-                new_width = X_RES
+                new_width = self.width
                 new_height = int(new_width / img_ratio)
 
-            # Resize the image
-            img = img.resize((new_width, new_height), Image.LANCZOS)
-
-            # Calculate the crop box
-            left = (new_width - X_RES) // 2
-            top = (new_height - Y_RES) // 2
-            right = left + X_RES
-            bottom = top + Y_RES
-
-            # Crop the image
-            img = img.crop((left, top, right, bottom))
+            # Crop box in the scaled, rotated image
+            left = (new_width - self.width) // 2
+            top = (new_height - self.height) // 2
+            box = rotate_box((left, top, left + self.width, top + self.height), (new_width, new_height), rotation)
+            resize_size = (self.height, self.width) if swap else (self.width, self.height)
+            offset = (0, 0)
         else:
             # Fit to screen (maintain aspect ratio, no cropping)
             if img_ratio > target_ratio:
                 # Image is wider, scale to match width
-                new_width = X_RES
-                new_height = int(X_RES / img_ratio)
+                new_width = self.width
+                new_height = int(self.width / img_ratio)
             else:
                 # Image is taller, scale to match height
-                new_height = Y_RES
-                new_width = int(Y_RES * img_ratio)
+                new_height = self.height
+                new_width = int(self.height * img_ratio)
 
-            # Resize the image
-            img = img.resize((new_width, new_height), Image.LANCZOS)
+            box = None
+            resize_size = (new_height, new_width) if swap else (new_width, new_height)
+            # Center the image on the black screen
+            offset = ((self.width - new_width) // 2, (self.height - new_height) // 2)
 
-        # Create a black background
-        background = Image.new('RGB', (X_RES, Y_RES), (0, 0, 0))
+        scaled_size = (new_height, new_width) if swap else (new_width, new_height)
+        if box is not None:
+            # Map the crop box from the scaled image back to the source so a
+            # single resize produces the cropped screen directly
+            scale_x = size[0] / scaled_size[0]
+            scale_y = size[1] / scaled_size[1]
+            box = (box[0] * scale_x, box[1] * scale_y, box[2] * scale_x, box[3] * scale_y)
+        return scaled_size, resize_size, box, offset
 
-        # Paste the processed image onto the center of the black background
-        offset = ((X_RES - img.width) // 2, (Y_RES - img.height) // 2)
+    def composite(self, img, offset):
+        # Put img on a black screen-sized canvas, unless it already covers it
+        if img.size == (self.width, self.height):
+            return img
+        background = Image.new('L', (self.width, self.height), 0)
         background.paste(img, offset)
-        img = background
+        return background
+
+    def process(self, source, crop=False, rotation=0, auto_rotate=False, timings=None):
+        # auto_rotate turns landscape sources by 90 degrees, see need_rotation.
+        # timings, if given, gets the seconds spent in every step (see scale)
+        img, offset = self.scale(source, crop, rotation, auto_rotate, timings)
+        # Return the processed image on a black background
+        with timed(timings, "composite"):
+            return self.composite(img, offset)
+
+    def scale(self, source, crop=False, rotation=0, auto_rotate=False, timings=None):
+        # The grayscale, resized and rotated image and its offset on the
+        # screen, without the black background around it. timings, if given,
+        # gets the seconds spent decoding, converting, resizing and rotating
+        with open_image(source) as img:
+            if auto_rotate and img.width > img.height:
+                rotation = 1
+            with timed(timings, "decode"):
+                scaled_size, resize_size, box, offset = self.plan(img.size, rotation, crop)
+
+                # Let JPEGs decode straight to grayscale at the smallest scale
+                # that is still at least as large as needed, a no-op for other formats
+                original_size = img.size
+                img.draft('L', scaled_size)
+                if img.size != original_size:
+                    scaled_size, resize_size, box, offset = self.plan(img.size, rotation, crop)
+                img.load()
+
+            # convert to grayscale
+            with timed(timings, "grayscale"):
+                if img.mode != 'L':
+                    img = img.convert('L')
 
-        
+            # Resize (and crop) the image, large downscales go through reduce() first
+            with timed(timings, "resize"):
+                img = img.resize(resize_size, Image.LANCZOS, box=box, reducing_gap=REDUCING_GAP)
 
-        # convert to grayscale
-        img = img.convert('L')
+            # Rotate image if needed, only screen-sized pixels are touched now
+            with timed(timings, "rotate"):
+                if rotation:
+                    img = img.transpose(ROTATIONS[rotation])
 
-        # Return the processed image
-        return img
+            return img, offset
 
+def rotate_box(box, size, rotation):
+    # Map a box in an image rotated by rotation * 90 degrees counter-clockwise
+    # (same as Image.rotate) back to the unrotated image. size is the rotated size
+    left, top, right, bottom = box
+    width, height = size
+    if rotation == 1:
+        return (height - bottom, left, height - top, right)
+    if rotation == 2:
+        return (width - right, height - bottom, width - left, height - top)
+    if rotation == 3:
+        return (top, width - right, bottom, width - left)
+    return box
 
+# Shared by callers that just want a processed image
+DEFAULT_PIPELINE = ImagePipeline()
+_pipelines = {(X_RES, Y_RES): DEFAULT_PIPELINE}
 
+def get_pipeline(size=(X_RES, Y_RES)):
+    # Shared pipeline for screens of another resolution
+    if size not in _pipelines:
+        _pipelines[size] = ImagePipeline(size=size)
+    return _pipelines[size]
+
+def process_image(input_path, crop=False, rotation=0, auto_rotate=False):
+    return DEFAULT_PIPELINE.process(input_path, crop, rotation, auto_rotate)
+
+
+def convert_image(input_path, output_path, crop=False, rotation=0, dither=None, cache=None, key=None):
+    # Process input_path and save it as a PNG at output_path. The source key
+    # (see source_key) is stored in the PNG so batch runs can tell whether
+    # the output is up to date
+    data = None
+    if cache is not None:
+        key = key or source_key(input_path, crop=crop, rotation=rotation, dither=dither)
+        data = cache.get(key)
+
+    if data is None:
+        # Process the image for the kindle display
+        img = process_image(input_path, crop, rotation)
+        if dither:
+            img = quantize_image(img, dither)
+        info = None
+        if key is not None:
+            info = PngImagePlugin.PngInfo()
+            info.add_text(SOURCE_KEY, key)
+        buffer = io.BytesIO()
+        img.save(buffer, 'PNG', pnginfo=info)
+        data = buffer.getvalue()
+        if cache is not None:
+            cache.put(key, data)
+
+    # Save the processed image
+    with open(output_path, 'wb') as f:
+        f.write(data)
+
+
+def source_key(input_path, **options):
+    # Hash of the source's content and the processing options, the same key
+    # the frame cache uses for the PNG
+    return FrameCache(directory=None).key(input_path, transfer_format="png", **options)
+
+
+def is_up_to_date(input_path, output_path, check, **options):
+    # check is "mtime" (output newer than the source) or "hash" (output made
+    # from the same content with the same options, see convert_image)
+    if not os.path.exists(output_path):
+        return False
+    if check == "mtime":
+        return os.path.getmtime(output_path) >= os.path.getmtime(input_path)
+    try:
+        with Image.open(output_path) as img:
+            return img.text.get(SOURCE_KEY) == source_key(input_path, **options)
+    except (OSError, AttributeError):
+        return False
+
+
+def find_inputs(patterns, output_dir):
+    # Expand files, directories (recursively) and glob patterns into
+    # (input path, output path) pairs. Files in a directory keep their
+    # place relative to it, everything else lands directly in output_dir
+    jobs = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, _, files in os.walk(pattern):
+                for name in sorted(files):
+                    if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                        path = os.path.join(root, name)
+                        jobs.append((path, os.path.relpath(path, pattern)))
+        else:
+            paths = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+            jobs.extend((path, os.path.basename(path)) for path in paths if os.path.isfile(path))
+    return [(path, os.path.join(output_dir, os.path.splitext(name)[0] + ".png")) for path, name in jobs]
+
+
+_batch_cache = None
+
+def convert_job(job):
+    # Runs in a worker process. Returns (input path, output path, "done",
+    # "skipped" or the error message)
+    global _batch_cache
+    input_path, output_path, options, check, use_cache = job
+    try:
+        if check and is_up_to_date(input_path, output_path, check, **options):
+            return input_path, output_path, "skipped"
+        if use_cache and _batch_cache is None:
+            _batch_cache = FrameCache()
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        key = source_key(input_path, **options) if check == "hash" else None
+        convert_image(input_path, output_path, cache=_batch_cache, key=key, **options)
+        return input_path, output_path, "done"
+    except Exception as e:
+        return input_path, output_path, f"failed: {e}"
+
+
+def find_collisions(inputs):
+    # Output paths that more than one input maps to, e.g. a.jpg and a.png or
+    # same-named files from two patterns, as {output path: [input paths]}
+    outputs = {}
+    for input_path, output_path in inputs:
+        outputs.setdefault(os.path.normcase(os.path.abspath(output_path)), []).append(input_path)
+    return {path: paths for path, paths in outputs.items() if len(paths) > 1}
+
+
+def convert_batch(patterns, output_dir, options, jobs=None, check="mtime", use_cache=False):
+    # Convert every image matched by patterns across a process pool, prints
+    # progress as files finish. Inputs that would overwrite each other's
+    # output aren't converted and count as failures. Returns the number of failures
+    inputs = find_inputs(patterns, output_dir)
+    if not inputs:
+        print("No images found")
+        return 0
+    collisions = find_collisions(inputs)
+    for output_path, input_paths in collisions.items():
+        print(f"{', '.join(input_paths)} would all be written to {output_path}, skipping them")
+    tasks = [(input_path, output_path, options, check, use_cache) for input_path, output_path in inputs
+             if os.path.normcase(os.path.abspath(output_path)) not in collisions]
+    counts = {"done": 0, "skipped": 0, "failed": sum(len(paths) for paths in collisions.values())}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        futures = [executor.submit(convert_job, task) for task in tasks]
+        for i, future in enumerate(as_completed(futures), 1):
+            input_path, output_path, status = future.result()
+            counts[status.split(":")[0]] += 1
+            print(f"[{i}/{len(tasks)}] {input_path} -> {output_path}: {status}")
+    seconds = time.perf_counter() - start
+    print(f"{counts['done']} converted, {counts['skipped']} up to date, {counts['failed']} failed in {seconds:.1f}s "
+          f"({counts['done'] / seconds if seconds else 0:.1f} images/s)")
+    return counts["failed"]
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process and output a grayscale png for Kindle display.")
-    parser.add_argument("input_image", help="Path to the input image file")
+    parser.add_argument("input_image", nargs="+", help="Path to the input image file. Several files, directories or glob patterns convert everything into --output-dir")
     parser.add_argument("-o", "--output", default="output.png", help="Path to the output image file (default: output.png)")
+    parser.add_argument("-O", "--output-dir", default=None, help="Convert in batch mode into this directory (default: processed, when more than one image is given)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Worker processes in batch mode (default: number of cores)")
+    parser.add_argument("--check", choices=["mtime", "hash"], default="mtime", help="How batch mode decides an output is up to date: newer than its source, or made from the same content and options (default: mtime)")
+    parser.add_argument("--force", action="store_true", help="Convert every image in batch mode, even if its output is up to date")
     parser.add_argument("-c", "--crop", action="store_true", help="Crop the image to fill the screen instead of fitting to screen")
     parser.add_argument("-r", "--rotate", type=int, choices=[0, 1, 2, 3], default=0, help="Rotate the image (0: no rotation, 1: 90 degrees CW, 2: 180 degrees, 3: 270 degrees CW)")
+    parser.add_argument("--dither", choices=DITHER_MODES, default=None, help="Quantize to the panel's 16 gray levels with this dithering")
+    parser.add_argument("--cache", action="store_true", help="Reuse processed images from the frame cache in " + CACHE_DIR)
     
     args = parser.parse_args()
 
-    # Process the image for the kindle display
-    img = process_image(args.input_image, args.crop, args.rotate)
+    options = {"crop": args.crop, "rotation": args.rotate, "dither": args.dither}
+    single = len(args.input_image) == 1 and os.path.isfile(args.input_image[0]) and args.output_dir is None
+    if not single:
+        failures = convert_batch(args.input_image, args.output_dir or "processed", options, args.jobs, None if args.force else args.check, args.cache)
+        raise SystemExit(1 if failures else 0)
 
-    # Save the processed image
-    img.save(args.output, 'PNG')
+    cache = FrameCache() if args.cache else None
+    convert_image(args.input_image[0], args.output, cache=cache, **options)
+    if cache is not None:
+        print(f"Frame cache: {cache.stats()}")
@@ -6,23 +6,77 @@ import zipfile
 import datetime
 import html
 from bs4 import BeautifulSoup
+from PIL import Image
+from article_store import ArticleStore, ARTICLE_STORE_PATH
+from http_cache import HttpCache, HTTP_CACHE_DIR
+from process_image import ImagePipeline, X_RES, Y_RES
 import re
 import os
 from urllib.parse import urljoin, urlparse
-import pickle
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from time import sleep
 
 
 
 BOOKS_DIR_PATH = '/mnt/us/newsletter/'
+RSS_URLS = [
+    'http://rss.cnn.com/rss/cnn_topstories.rss',
+    'http://feeds.bbci.co.uk/news/rss.xml',
+    'https://lwn.net/headlines/rss',
+    'https://www.space.com/home/feed/site.xml',
+    'https://www.newscientist.com/feed/home/?cmpid=RSS|NSNS-Home',
+    'http://www.theverge.com/rss/frontpage',
+    'https://feeds.arstechnica.com/arstechnica/index',
+    'https://hackaday.com/blog/feed/',
+    'https://hnrss.org/frontpage',
+    'https://www.nasa.gov/news-release/feed/',
+    'https://www.nature.com/nature.rss',
+    'https://www.producthunt.com/feed',
+    'https://kingstut.substack.com/feed',
+    'https://xistance.substack.com/feed',
+]
+# Timeout of a single request, in seconds
+FETCH_TIMEOUT = 10
+# Feeds are fetched this many at a time
+FETCH_WORKERS = 6
+# Whatever hasn't arrived this many seconds after the first request is left out
+FETCH_DEADLINE = 30
+# Article images are fetched and prepared this many at a time, within their own deadline
+IMAGE_WORKERS = 4
+IMAGE_DEADLINE = 60
+# Images above either limit are left out
+MAX_IMAGE_BYTES = 5 * 1024 * 1024
+MAX_IMAGE_PIXELS = 40 * 1000 * 1000
+IMAGE_QUALITY = 75
+# Sources in these formats (line art, screenshots) stay lossless, the rest become JPEGs
+LOSSLESS_FORMATS = {'PNG', 'GIF', 'BMP'}
+ATOM = '{http://www.w3.org/2005/Atom}'
+# Feeds that list their articles newest first. Parsing them stops at the first
+# article that was already processed, everything after it was seen before.
+# Ranked feeds like hnrss.org's front page don't belong here
+ORDERED_FEEDS = {
+    'https://lwn.net/headlines/rss',
+    'https://feeds.arstechnica.com/arstechnica/index',
+    'https://hackaday.com/blog/feed/',
+    'https://www.nature.com/nature.rss',
+    'https://kingstut.substack.com/feed',
+    'https://xistance.substack.com/feed',
+}
 
 try:
     from dateutil import parser as date_parser
 except ImportError:
     date_parser = None
 
-# Set of processed articles
+# GUIDs of processed articles, an ArticleStore once main has opened it
 processed_articles = set()
+# Conditional-request cache for feeds and images, set up by main
+http_cache = None
+# Returned by fetch_rss for a feed that didn't change since the last run
+NOT_MODIFIED = object()
 
 def parse_date(date_string):
     if date_parser:
@@ -42,15 +96,65 @@ def parse_date(date_string):
                 pass
         raise ValueError(f"Unable to parse date string: {date_string}")
 
-def fetch_rss(url):
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    # One session for all requests, connections to a host are kept open and
+    # reused. Its pool is big enough for every fetch worker
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=FETCH_WORKERS, pool_maxsize=FETCH_WORKERS)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+def fetch_rss(url, timeout=FETCH_TIMEOUT):
+    # Returns NOT_MODIFIED if the server says the feed didn't change since it
+    # was cached, it needs neither downloading nor parsing then
     try:
-        response = requests.get(url, timeout=10)
+        headers = http_cache.validators(url) if http_cache is not None else {}
+        response = get_session().get(url, timeout=timeout, headers=headers)
+        if response.status_code == 304 and http_cache.not_modified(url) is not None:
+            return NOT_MODIFIED
         response.raise_for_status()
+        if http_cache is not None:
+            # Only cached once the run finishes, see main
+            http_cache.store(url, response.headers, response.content, defer=True)
         return response.content  # Return bytes instead of text
     except requests.RequestException as e:
         print(f"Error fetching feed from {url}: {e}")
         return None
 
+def fetch_timed(url, deadline):
+    # deadline is a time.monotonic() value, requests still running then
+    # time out soon after instead of keeping the program alive
+    start = time.monotonic()
+    content = fetch_rss(url, max(0.1, min(FETCH_TIMEOUT, deadline - start)))
+    if content is NOT_MODIFIED:
+        size = "not modified"
+    else:
+        size = f"{len(content)} bytes" if content is not None else "failed"
+    print(f"Fetched {url} in {time.monotonic() - start:.2f}s ({size})")
+    return content
+
+def fetch_feeds(urls, workers=FETCH_WORKERS, deadline=FETCH_DEADLINE):
+    # Fetch all feeds concurrently. Returns {url: content} for the feeds that
+    # arrived before the deadline, in the order of urls
+    executor = ThreadPoolExecutor(max_workers=workers)
+    end = time.monotonic() + deadline
+    futures = {url: executor.submit(fetch_timed, url, end) for url in urls}
+    done, pending = wait(futures.values(), timeout=deadline)
+    # Don't wait for the stragglers, their requests time out on their own
+    executor.shutdown(wait=False, cancel_futures=True)
+    for url, future in futures.items():
+        if future in pending:
+            print(f"Gave up on {url} after the {deadline}s deadline")
+    return {url: future.result() for url, future in futures.items()
+            if future in done and future.result() and future.result() is not NOT_MODIFIED}
+
 def clean_html(html_content):
     soup = BeautifulSoup(html_content, 'html.parser')
     for tag in soup(['script', 'style']):
@@ -61,108 +165,200 @@ def clean_html(html_content):
     text = '\n'.join(chunk for chunk in chunks if chunk)
     return text
 
-def fetch_image(image_url, feed_url):
+def fetch_image(image_url, feed_url, timeout=FETCH_TIMEOUT):
+    # Returns None for images larger than MAX_IMAGE_BYTES, which are only
+    # downloaded up to that point
     try:
         full_url = urljoin(feed_url, image_url)
-        response = requests.get(full_url, timeout=10)
-        response.raise_for_status()
-        return response.content
+        headers = http_cache.validators(full_url) if http_cache is not None else {}
+        with get_session().get(full_url, timeout=timeout, stream=True, headers=headers) as response:
+            if response.status_code == 304:
+                content = http_cache.not_modified(full_url)
+                if content is not None:
+                    return content
+            response.raise_for_status()
+            length = response.headers.get('Content-Length')
+            if length and length.isdigit() and int(length) > MAX_IMAGE_BYTES:
+                print(f"Skipping image {image_url}: {length} bytes")
+                return None
+            content = bytearray()
+            for chunk in response.iter_content(64 * 1024):
+                content += chunk
+                if len(content) > MAX_IMAGE_BYTES:
+                    print(f"Skipping image {image_url}: more than {MAX_IMAGE_BYTES} bytes")
+                    return None
+            if http_cache is not None:
+                http_cache.store(full_url, response.headers, bytes(content))
+            return bytes(content)
     except requests.RequestException as e:
         print(f"Error fetching image from {image_url}: {e}")
         return None
 
+# Fits images to the Kindle's screen, shared by the image workers
+IMAGE_PIPELINE = ImagePipeline()
+
+def prepare_image(content, image_url):
+    # Fit the image to the screen (never enlarging it) in grayscale and
+    # re-encode it. Returns (data, media type, extension) or None
+    try:
+        img = Image.open(io.BytesIO(content))
+        if img.width * img.height > MAX_IMAGE_PIXELS:
+            print(f"Skipping image {image_url}: {img.width}x{img.height} pixels")
+            return None
+        source_format = img.format
+        # Transparent areas would turn black in grayscale, put them on white
+        if img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info):
+            img = Image.alpha_composite(Image.new('RGBA', img.size, 'white'), img.convert('RGBA'))
+        if img.width > X_RES or img.height > Y_RES:
+            img, _ = IMAGE_PIPELINE.scale(img)
+        else:
+            img = img.convert('L')
+        buffer = io.BytesIO()
+        if source_format in LOSSLESS_FORMATS:
+            img.save(buffer, 'PNG', optimize=True)
+            return buffer.getvalue(), 'image/png', 'png'
+        img.save(buffer, 'JPEG', quality=IMAGE_QUALITY, optimize=True)
+        return buffer.getvalue(), 'image/jpeg', 'jpg'
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        print(f"Error processing image {image_url}: {e}")
+        return None
+
+def load_image(image_url, deadline):
+    # Fetch and prepare one image, deadline is a time.monotonic() value
+    timeout = max(0.1, min(FETCH_TIMEOUT, deadline - time.monotonic()))
+    content = fetch_image(image_url, image_url, timeout)
+    if content is None:
+        return None
+    prepared = prepare_image(content, image_url)
+    if prepared is None:
+        return None
+    data, media_type, extension = prepared
+    return {'data': data, 'media_type': media_type, 'extension': extension, 'source_bytes': len(content)}
+
+def fetch_images(all_items, workers=IMAGE_WORKERS, deadline=IMAGE_DEADLINE):
+    # Fetch and prepare every article image concurrently, each URL only
+    # once, and attach the result to the items (None if it failed)
+    references = [item['image_url'] for items in all_items.values() for item in items if item['image_url']]
+    urls = list(dict.fromkeys(references))
+    images = {}
+    if urls:
+        executor = ThreadPoolExecutor(max_workers=workers)
+        end = time.monotonic() + deadline
+        futures = {url: executor.submit(load_image, url, end) for url in urls}
+        done, pending = wait(futures.values(), timeout=deadline)
+        executor.shutdown(wait=False, cancel_futures=True)
+        for index, (url, future) in enumerate(futures.items()):
+            if future in pending:
+                print(f"Gave up on image {url} after the {deadline}s deadline")
+            elif future.result() is not None:
+                image = images[url] = future.result()
+                image['filename'] = f"image_{index}.{image['extension']}"
+    for items in all_items.values():
+        for item in items:
+            item['image'] = images.get(item['image_url'])
+    source_bytes = sum(image['source_bytes'] for image in images.values())
+    epub_bytes = sum(len(image['data']) for image in images.values())
+    print(f"Images: {len(images)} of {len(urls)} unique ({len(references)} references), "
+          f"{source_bytes // 1024} KB downloaded, {epub_bytes // 1024} KB in the EPUB")
+
 def parse_feed(xml_content, feed_url):
+    # Items are handled one at a time as the parser reaches their end tag,
+    # no tree of the whole feed is built. The GUID is checked before any HTML
+    # work, and every item is dropped from the tree once it's done
     if xml_content is None:
         return []
-    
+
+    parsed_items = []
+    is_atom = None
+    found = 0
+    # Open elements, the parent of a finished item is the last one
+    open_elements = []
     try:
-        # Parse XML content directly without escaping
-        root = ET.fromstring(xml_content)
+        for event, element in ET.iterparse(io.BytesIO(xml_content), events=('start', 'end')):
+            if event == 'start':
+                if is_atom is None:
+                    # Detect feed type (RSS or Atom) from the root element
+                    is_atom = element.tag == ATOM + 'feed'
+                open_elements.append(element)
+                continue
+            open_elements.pop()
+            if element.tag != (ATOM + 'entry' if is_atom else 'item') or not open_elements:
+                continue
+            found += 1
+            guid = item_guid(element, is_atom)
+
+            # Check if article has already been processed
+            if guid is not None and guid in processed_articles:
+                print(f"Skipping article with GUID {guid}")
+                if feed_url in ORDERED_FEEDS:
+                    # Everything after it is older and was seen as well
+                    print(f"Stopping at the first article already seen in {feed_url}")
+                    break
+            else:
+                if guid is not None:
+                    processed_articles.add(guid)
+                print(f"Processing article with GUID {guid}")
+                parsed_items.append(parse_item(element, feed_url, is_atom))
+            element.clear()
+            open_elements[-1].remove(element)
     except ET.ParseError as e:
+        # Items before the error are kept, they are marked as processed already
         print(f"Error parsing XML content: {e}")
-        return []
-    
-    # Detect feed type (RSS or Atom)
-    if root.tag == '{http://www.w3.org/2005/Atom}feed':
-        return parse_atom(root, feed_url)
-    elif root.find('channel') is not None:
-        return parse_rss(root, feed_url)
+        return parsed_items
+
+    if not found:
+        print(f"Error: No '{'entry' if is_atom else 'item'}' elements found in the {'Atom' if is_atom else 'RSS'} feed")
+    return parsed_items
+
+def item_guid(item, is_atom):
+    # The id of an item, its link for feeds that leave the id out
+    if is_atom:
+        guid = item.find(ATOM + 'id')
+        if guid is not None and guid.text:
+            return guid.text
+        link = item.find(ATOM + 'link')
+        return link.get('href') if link is not None else None
+    guid = item.find('guid')
+    if guid is not None and guid.text:
+        return guid.text
+    link = item.find('link')
+    return link.text if link is not None else None
+
+def parse_item(item, feed_url, is_atom):
+    if is_atom:
+        title = item.find(ATOM + 'title')
+        description = item.find(ATOM + 'content')
+        pub_date = item.find(ATOM + 'published')
+        if pub_date is None:
+            pub_date = item.find(ATOM + 'updated')
+        link = item.find(ATOM + 'link')
     else:
-        print("Error: Unable to determine feed type (RSS or Atom)")
-        return []
+        title = item.find('title')
+        description = item.find('description')
+        pub_date = item.find('pubDate')
+        link = item.find('link')
 
-def parse_rss(root, feed_url):
-    channel = root.find('channel')
-    if channel is None:
-        print("Error: Unable to find 'channel' element in the RSS feed")
-        return []
-    
-    items = channel.findall('item')
-    if not items:
-        print("Error: No 'item' elements found in the RSS feed")
-        return []
-    
-    return parse_items(items, feed_url, is_atom=False)
+    # Clean and escape HTML content
+    title_text = html.escape(title.text) if title is not None and title.text else 'No title'
+    description_text = description.text if description is not None and description.text else 'No description'
+    clean_description = clean_html(html.unescape(description_text))
 
-def parse_atom(root, feed_url):
-    items = root.findall('{http://www.w3.org/2005/Atom}entry')
-    if not items:
-        print("Error: No 'entry' elements found in the Atom feed")
-        return []
-    
-    return parse_items(items, feed_url, is_atom=True)
+    # Find the image, it is fetched later for all articles at once (see fetch_images)
+    image_url = None
+    if description is not None:
+        soup = BeautifulSoup(description_text, 'html.parser')
+        img_tag = soup.find('img')
+        if img_tag and 'src' in img_tag.attrs:
+            image_url = urljoin(feed_url, img_tag['src'])
 
-def parse_items(items, feed_url, is_atom):
-    parsed_items = []
-    for item in items:
-        guid = "NA"
-        if is_atom:
-            title = item.find('{http://www.w3.org/2005/Atom}title')
-            description = item.find('{http://www.w3.org/2005/Atom}content')
-            pub_date = item.find('{http://www.w3.org/2005/Atom}published') or item.find('{http://www.w3.org/2005/Atom}updated')
-            link = item.find('{http://www.w3.org/2005/Atom}link')
-            guid = item.find('{http://www.w3.org/2005/Atom}id')
-        else:
-            title = item.find('title')
-            description = item.find('description')
-            pub_date = item.find('pubDate')
-            link = item.find('link')
-            guid = item.find('guid')
-        print(guid.text)
-
-        # Check if article has already been processed
-        if guid.text in processed_articles:
-            print(f"Skipping article with GUID {guid.text}")
-            continue
-        else:
-            processed_articles.add(guid.text)
-            print(f"Processing article with GUID {guid.text}")
-
-        # Clean and escape HTML content
-        title_text = html.escape(title.text) if title is not None else 'No title'
-        description_text = description.text if description is not None else 'No description'
-        clean_description = clean_html(html.unescape(description_text))
-        
-        # Find and fetch image
-        image_url = None
-        if description is not None:
-            soup = BeautifulSoup(description_text, 'html.parser')
-            img_tag = soup.find('img')
-            if img_tag and 'src' in img_tag.attrs:
-                image_url = img_tag['src']
-        
-        image_content = fetch_image(image_url, feed_url) if image_url else None
-        
-        parsed_items.append({
-            'title': title_text,
-            'description': clean_description,
-            'pub_date': pub_date.text if pub_date is not None else 'No date',
-            'link': link.get('href') if is_atom and link is not None else (link.text if link is not None else '#'),
-            'image': image_content,
-            'image_url': image_url
-        })
-    
-    return parsed_items
+    return {
+        'title': title_text,
+        'description': clean_description,
+        'pub_date': pub_date.text if pub_date is not None else 'No date',
+        'link': link.get('href') if is_atom and link is not None else (link.text if link is not None else '#'),
+        'image': None,
+        'image_url': image_url
+    }
 
 def create_epub(feed_items, output_filename):
     epub = zipfile.ZipFile(output_filename, 'w')
@@ -194,13 +390,16 @@ def create_epub(feed_items, output_filename):
     <item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>
 '''
 
-    # Add items to manifest
+    # Add items to manifest, images shared by several articles only once
+    image_filenames = set()
     for i, (feed_url, items) in enumerate(feed_items.items()):
         content_opf += f'    <item id="feed{i}" href="feed{i}.html" media-type="application/xhtml+xml"/>\n'
-        for j, item in enumerate(items):
-            if item['image']:
-                image_filename = f"image_{i}_{j}.jpg"
-                content_opf += f'    <item id="image_{i}_{j}" href="{image_filename}" media-type="image/jpeg"/>\n'
+        for item in items:
+            image = item['image']
+            if image and image['filename'] not in image_filenames:
+                image_filenames.add(image['filename'])
+                image_id = os.path.splitext(image['filename'])[0]
+                content_opf += f'    <item id="{image_id}" href="{image["filename"]}" media-type="{image["media_type"]}"/>\n'
 
     content_opf += '''  </manifest>
   <spine toc="ncx">
@@ -245,6 +444,7 @@ def create_epub(feed_items, output_filename):
     epub.writestr('OEBPS/toc.ncx', toc_ncx)
     
     # Add content HTML files for each feed
+    written_images = set()
     for i, (feed_url, items) in enumerate(feed_items.items()):
         feed_name = urlparse(feed_url).netloc
         content_html = f'''<?xml version="1.0" encoding="UTF-8"?>
@@ -262,10 +462,12 @@ def create_epub(feed_items, output_filename):
   <h2>{item['title']}</h2>
   <p><em>Published: {item['pub_date']}</em></p>
 '''
-            if item['image']:
-                image_filename = f"image_{i}_{j}.jpg"
-                content_html += f'  <img src="{image_filename}" alt="{item["title"]}"/>\n'
-                epub.writestr(f'OEBPS/{image_filename}', item['image'])
+            image = item['image']
+            if image:
+                content_html += f'  <img src="{image["filename"]}" alt="{item["title"]}"/>\n'
+                if image['filename'] not in written_images:
+                    written_images.add(image['filename'])
+                    epub.writestr(f'OEBPS/{image["filename"]}', image['data'])
 
             content_html += f'''
   <p>{item['description']}</p>
@@ -278,54 +480,53 @@ def create_epub(feed_items, output_filename):
     epub.close()
 
 def main():
+    parser = argparse.ArgumentParser(description="Build an EPUB newsletter from RSS and Atom feeds.")
+    parser.add_argument("--feed", action="append", help="Feed URL, repeat for several (default: the built-in list)")
+    parser.add_argument("--output-dir", default=BOOKS_DIR_PATH, help=f"Directory the EPUB is saved to (default: {BOOKS_DIR_PATH})")
+    parser.add_argument("--workers", type=int, default=FETCH_WORKERS, help=f"Feeds fetched at the same time (default: {FETCH_WORKERS})")
+    parser.add_argument("--deadline", type=float, default=FETCH_DEADLINE, help=f"Seconds after which feeds that haven't arrived are left out (default: {FETCH_DEADLINE})")
+    parser.add_argument("--store", default=ARTICLE_STORE_PATH, help=f"Database of processed articles and the last run (default: {ARTICLE_STORE_PATH})")
+    parser.add_argument("--no-http-cache", action="store_true", help=f"Download everything again instead of asking whether it changed since the copy in {HTTP_CACHE_DIR}")
+    args = parser.parse_args()
+
     os.system('eips 0 1 "RSS Feed EPUB program was run."')
 
-    # Check when the script was last run using a pickle file
-    if os.path.exists('last_run.pickle'):
-        with open('last_run.pickle', 'rb') as f:
-            last_run = pickle.load(f)
-            # Compare the last run date with today's date
-            if last_run.date() == datetime.datetime.now().date():
-                print('RSS Feed EPUB program was already run today.')
-                return
+    global processed_articles
+    processed_articles = ArticleStore(args.store)
+    try:
+        run(args)
+    finally:
+        # Whatever wasn't committed by run is dropped
+        processed_articles.close()
+
+def run(args):
+    # Check when the script was last run
+    last_run = processed_articles.last_run()
+    # Compare the last run date with today's date
+    if last_run is not None and last_run.date() == datetime.datetime.now().date():
+        print('RSS Feed EPUB program was already run today.')
+        return
 
     # Sleep for 10 seconds before starting the program
     sleep(10)
-    # import pickle data, if exists
-    global processed_articles
-    if os.path.exists('processed_articles.pickle'):
-        with open('processed_articles.pickle', 'rb') as f:
-            processed_articles = pickle.load(f)
-    
-    rss_urls = [
-        'http://rss.cnn.com/rss/cnn_topstories.rss',
-        'http://feeds.bbci.co.uk/news/rss.xml',
-        'https://lwn.net/headlines/rss',
-        'https://www.space.com/home/feed/site.xml',
-        'https://www.newscientist.com/feed/home/?cmpid=RSS|NSNS-Home',
-        'http://www.theverge.com/rss/frontpage',
-        'https://feeds.arstechnica.com/arstechnica/index',
-        'https://hackaday.com/blog/feed/',
-        'https://hnrss.org/frontpage',
-        'https://www.nasa.gov/news-release/feed/',
-        'https://www.nature.com/nature.rss',
-        'https://www.producthunt.com/feed',
-        'https://kingstut.substack.com/feed',
-        'https://xistance.substack.com/feed',
-    ]
+    global http_cache
+    if not args.no_http_cache:
+        http_cache = HttpCache()
     
     all_items = {}
-    for url in rss_urls:
-        print(f"Fetching feed from {url}")
-        xml_content = fetch_rss(url)
-        if xml_content:
-            items = parse_feed(xml_content, url)
-            if items:
-                all_items[url] = items
+    start = time.monotonic()
+    feeds = fetch_feeds(args.feed or RSS_URLS, args.workers, args.deadline)
+    print(f"Fetched {len(feeds)} feeds in {time.monotonic() - start:.2f}s")
+    for url, xml_content in feeds.items():
+        items = parse_feed(xml_content, url)
+        if items:
+            all_items[url] = items
     
     if not all_items:
         print("No items were successfully fetched and parsed. EPUB creation aborted.")
         return
+
+    fetch_images(all_items)
     
     # Sort items in each feed by publication date
     for url, items in all_items.items():
@@ -336,21 +537,27 @@ def main():
             print("Continuing without sorting for this feed...")
     
     epub_filename = f'rss_newsletter_{datetime.datetime.now().strftime("%d")}.epub'
-    epub_path = os.path.join(BOOKS_DIR_PATH, epub_filename)
+    epub_path = os.path.join(args.output_dir, epub_filename)
     print(f"EPUB file will be saved to {epub_path}")
     
     create_epub(all_items, epub_path)
     print("EPUB file has been created successfully.")
     
-    # Save processed articles to pickle file
-    with open('processed_articles.pickle', 'wb') as f:
-        pickle.dump(processed_articles, f)
+    # Save the processed articles and the date of this run in one go
+    processed_articles.set_last_run()
+    added = processed_articles.added
+    expired = processed_articles.commit()
+    print(f"Recorded {added} new articles, forgot {expired} old ones, {len(processed_articles)} remembered")
 
-    # Save the date when the script was last run
-    with open('last_run.pickle', 'wb') as f:
-        pickle.dump(datetime.datetime.now(), f)
+    # Feeds are only cached now, so a run that didn't get this far still
+    # sees their articles next time instead of a 304
+    if http_cache is not None:
+        http_cache.commit()
+        stats = http_cache.stats()
+        print(f"HTTP cache: {stats['hits']} not modified, {stats['misses']} downloaded, "
+              f"{stats['bytes_saved'] // 1024} KB saved, {stats['bytes_downloaded'] // 1024} KB downloaded")
     
-    os.system(f'eips 0 1 "EPUB file has been created successfully. Saved to {BOOKS_DIR_PATH}"')
+    os.system(f'eips 0 1 "EPUB file has been created successfully. Saved to {args.output_dir}"')
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,240 @@
+from PIL import Image, ImageGrab
+import os
+import subprocess
+import sys
+import tempfile
+import numpy as np
+
+CAPTURE_BACKENDS = ["auto", "mac", "x11", "framebuffer", "synthetic", "video"]
+# Pillow raw modes for the usual framebuffer depths
+FRAMEBUFFER_MODES = {
+    8: ("L", "L"),
+    16: ("RGB", "BGR;16"),
+    24: ("RGB", "BGR"),
+    32: ("RGB", "BGRX"),
+}
+SYNTHETIC_SIZE = (1920, 1080)
+# Pixels the synthetic test pattern's bar moves per frame
+SYNTHETIC_SPEED = 24
+
+# Every backend returns frames as in-memory PIL images from grab(box), where
+# box is an optional (left, top, right, bottom) region of the screen to
+# capture instead of all of it. size is the full screen size.
+
+class MacCapture:
+    # macOS screen through Quartz (pyobjc) in-process. Without pyobjc it
+    # falls back to the screencapture command and a temporary file. Either
+    # way only the box is captured. macOS takes the box in points, which
+    # are scale pixels each on Retina displays
+    def __init__(self, display=1):
+        self.display = display
+        try:
+            import Quartz
+        except ImportError:
+            Quartz = None
+            print("pyobjc-framework-Quartz not installed, capturing with screencapture")
+        self.quartz = Quartz
+        if Quartz is not None:
+            _, display_ids, _ = Quartz.CGGetActiveDisplayList(16, None, None)
+            self.display_id = display_ids[display - 1]
+        self.path = os.path.join(tempfile.gettempdir(), f"kindle_display_capture_{os.getpid()}.png")
+        self.scale = 1
+        self.size = self.grab().size
+        if Quartz is not None:
+            self.scale = self.size[0] / Quartz.CGDisplayBounds(self.display_id).size.width
+        else:
+            # A box of 10 points comes back 10 * scale pixels wide
+            self.scale = self.grab((0, 0, 10, 10)).width / 10
+
+    def grab(self, box=None):
+        # box is in pixels like the returned image, None for the whole display
+        left, top, right, bottom = box or (0, 0, 0, 0)
+        x, y = left / self.scale, top / self.scale
+        width, height = (right - left) / self.scale, (bottom - top) / self.scale
+        if self.quartz is None:
+            region = ["-R", f"{x:g},{y:g},{width:g},{height:g}"] if box else []
+            subprocess.run(["screencapture", "-x", "-D", str(self.display)] + region + ["-r", self.path], check=True)
+            with Image.open(self.path) as img:
+                img.load()
+            os.remove(self.path)
+            return img
+        quartz = self.quartz
+        if box:
+            image = quartz.CGDisplayCreateImageForRect(self.display_id, quartz.CGRectMake(x, y, width, height))
+        else:
+            image = quartz.CGDisplayCreateImage(self.display_id)
+        data = quartz.CGDataProviderCopyData(quartz.CGImageGetDataProvider(image))
+        size = (quartz.CGImageGetWidth(image), quartz.CGImageGetHeight(image))
+        return Image.frombuffer("RGB", size, bytes(data), "raw", "BGRX", quartz.CGImageGetBytesPerRow(image), 1)
+
+    def close(self):
+        pass
+
+
+class X11Capture:
+    # An X11 display, e.g. a real one or Xvfb, read in-process. With
+    # python-xlib only the box is requested from the X server (GetImage on
+    # the root window). Without it, Pillow's XCB support fetches the whole
+    # screen every time and the box is cropped out afterwards
+    def __init__(self, display=None):
+        self.display = display or os.environ.get("DISPLAY", ":0")
+        try:
+            from Xlib import X, display as xlib_display
+        except ImportError:
+            X = None
+            print("python-xlib not installed, capturing the whole X11 screen for every frame")
+        self.connection = None
+        if X is not None:
+            self.z_pixmap = X.ZPixmap
+            self.connection = xlib_display.Display(self.display)
+            self.root = self.connection.screen().root
+            # Only the usual 24-bit TrueColor layout is unpacked here
+            if self.connection.screen().root_depth != 24:
+                print(f"Unsupported X11 depth {self.connection.screen().root_depth}, capturing with Pillow")
+                self.connection.close()
+                self.connection = None
+        if self.connection is not None:
+            geometry = self.root.get_geometry()
+            self.size = (geometry.width, geometry.height)
+        else:
+            self.size = ImageGrab.grab(xdisplay=self.display).size
+
+    def grab(self, box=None):
+        if self.connection is None:
+            return ImageGrab.grab(bbox=box, xdisplay=self.display)
+        left, top, right, bottom = box or (0, 0) + self.size
+        reply = self.root.get_image(left, top, right - left, bottom - top, self.z_pixmap, 0xffffffff)
+        # 24-bit pixels come as 32-bit words, blue first
+        return Image.frombuffer("RGB", (right - left, bottom - top), reply.data, "raw", "BGRX", 0, 1)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+
+class FramebufferCapture:
+    # A Linux framebuffer device or a raw dump of one. For /dev/fbN the
+    # geometry comes from sysfs, otherwise size and bits_per_pixel have to
+    # be given. Only the rows of the box are read
+    def __init__(self, path="/dev/fb0", size=None, bits_per_pixel=None, stride=None):
+        sysfs = "/sys/class/graphics/" + os.path.basename(path)
+        if size is None and os.path.isdir(sysfs):
+            with open(sysfs + "/virtual_size") as f:
+                size = tuple(int(value) for value in f.read().split(","))
+            with open(sysfs + "/bits_per_pixel") as f:
+                bits_per_pixel = int(f.read())
+            with open(sysfs + "/stride") as f:
+                stride = int(f.read())
+        if size is None:
+            raise ValueError(f"Size of the framebuffer {path} unknown, give it as WIDTHxHEIGHT")
+        bits_per_pixel = bits_per_pixel or 32
+        if bits_per_pixel not in FRAMEBUFFER_MODES:
+            raise ValueError(f"Unsupported framebuffer depth {bits_per_pixel}")
+        self.size = size
+        self.mode, self.rawmode = FRAMEBUFFER_MODES[bits_per_pixel]
+        self.stride = stride or size[0] * bits_per_pixel // 8
+        self.file = open(path, "rb")
+
+    def grab(self, box=None):
+        left, top, right, bottom = box or (0, 0) + self.size
+        self.file.seek(top * self.stride)
+        data = self.file.read((bottom - top) * self.stride)
+        img = Image.frombuffer(self.mode, (self.size[0], bottom - top), data, "raw", self.rawmode, self.stride, 1)
+        if left or right != self.size[0]:
+            img = img.crop((left, 0, right, bottom - top))
+        return img
+
+    def close(self):
+        self.file.close()
+
+
+class SyntheticCapture:
+    # Test pattern for trying the stream without a screen: a fixed gradient
+    # with a bright bar that moves a bit every frame
+    def __init__(self, size=SYNTHETIC_SIZE):
+        self.size = size
+        width, height = size
+        gradient = np.linspace(0, 160, width, dtype=np.uint8)
+        self.background = np.repeat(np.tile(gradient, (height, 1))[:, :, np.newaxis], 3, axis=2)
+        self.frame = 0
+
+    def grab(self, box=None):
+        pixels = self.background.copy()
+        bar = self.frame * SYNTHETIC_SPEED % self.size[0]
+        pixels[:, bar:bar + SYNTHETIC_SPEED] = 255
+        self.frame += 1
+        img = Image.fromarray(pixels, mode="RGB")
+        return img.crop(box) if box else img
+
+    def close(self):
+        pass
+
+
+class VideoCapture:
+    # Frames of a video, looped. Animated GIF, PNG and WebP files are read
+    # with Pillow, other formats need OpenCV (cv2)
+    def __init__(self, path):
+        self.video = None
+        self.animation = None
+        try:
+            self.animation = Image.open(path)
+            self.size = self.animation.size
+        except Image.UnidentifiedImageError:
+            try:
+                import cv2
+            except ImportError:
+                raise RuntimeError(f"{path} isn't an animated image and OpenCV (cv2) isn't installed")
+            self.cv2 = cv2
+            self.video = cv2.VideoCapture(path)
+            if not self.video.isOpened():
+                raise RuntimeError(f"Can't open video {path}")
+            self.size = (int(self.video.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.video.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        self.frame = 0
+
+    def grab(self, box=None):
+        if self.animation is not None:
+            self.animation.seek(self.frame % getattr(self.animation, "n_frames", 1))
+            img = self.animation.convert("RGB")
+        else:
+            ok, pixels = self.video.read()
+            if not ok:
+                self.video.set(self.cv2.CAP_PROP_POS_FRAMES, 0)
+                ok, pixels = self.video.read()
+            # OpenCV frames are BGR
+            img = Image.fromarray(np.ascontiguousarray(pixels[:, :, ::-1]))
+        self.frame += 1
+        return img.crop(box) if box else img
+
+    def close(self):
+        if self.animation is not None:
+            self.animation.close()
+        if self.video is not None:
+            self.video.release()
+
+
+def parse_size(text):
+    width, _, height = text.lower().partition("x")
+    return int(width), int(height)
+
+
+def open_capture(backend="auto", source=None, display=1):
+    # source means: the X display for x11, the device or file (with
+    # :WIDTHxHEIGHT[:BITS] for dumps) for framebuffer, WIDTHxHEIGHT for
+    # synthetic and the file for video. display is the macOS display number
+    if backend == "auto":
+        backend = "mac" if sys.platform == "darwin" else "x11"
+    if backend == "mac":
+        return MacCapture(display)
+    if backend == "x11":
+        return X11Capture(source)
+    if backend == "framebuffer":
+        path, _, geometry = (source or "/dev/fb0").partition(":")
+        size, _, bits = geometry.partition(":")
+        return FramebufferCapture(path, parse_size(size) if size else None, int(bits) if bits else None)
+    if backend == "synthetic":
+        return SyntheticCapture(parse_size(source) if source else SYNTHETIC_SIZE)
+    if backend == "video":
+        if not source:
+            raise ValueError("The video capture needs a file")
+        return VideoCapture(source)
+    raise ValueError(f"Unknown capture backend {backend}")
@@ -1,49 +1,512 @@
-import os
 import argparse
-from kindle_display import display_image, keep_alive, set_backlight, get_actual_backlight
+import math
+import hashlib
+import queue
+import subprocess
+import threading
+import time
+import numpy as np
+from process_image import ImagePipeline, quantize_image, DITHER_MODES
+from kindle_display import send_image, send_encoded, send_regions, encode_image, keep_alive, ping, set_backlight, get_actual_backlight, get_connection, TRANSFER_FORMATS, AGENT_PORT
+from kindle_display import parse_target, group_targets, run_on_targets, fade_seconds, default_format, DEVICE_TIMEOUT
+from display_agent import AgentError
+from frame_stats import FrameStats, timed
+from screen_capture import open_capture, CAPTURE_BACKENDS
+
+# Frames are compared in square tiles, changed tiles are merged into rectangles
+DIRTY_TILE_SIZE = 16
+# Above this many rectangles a single bounding box is cheaper to send
+MAX_DIRTY_REGIONS = 8
+# How often blocked workers wake up to check whether the stream was stopped
+QUEUE_POLL_INTERVAL = 0.1
+# Captures are fingerprinted at 1/FINGERPRINT_REDUCTION of their size
+FINGERPRINT_REDUCTION = 4
+# While the screen is unchanged, capture at most this often (seconds)
+IDLE_CAPTURE_INTERVAL = 0.5
+# Transfer format and dithering the quality controller steps through, from
+# least work per frame to fewest bytes on the wire
+QUALITY_LADDER = [
+    ("raw", None),
+    ("zlib", None),
+    ("zlib4", "bayer"),
+]
+# Frames to wait after a quality change before judging it
+QUALITY_HOLD_FRAMES = 3
+# Weight of the newest measurement in the latency average
+LATENCY_SMOOTHING = 0.3
+RTT_PROBE_INTERVAL = 10
+# Share of the latency above which the round trip itself is the bottleneck,
+# a more compact format would barely help then
+RTT_BOUND_SHARE = 0.5
+MAX_FRAME_INTERVAL = 5.0
+# A Kindle is dropped from the stream after this many failed frames in a row
+MAX_DEVICE_FAILURES = 5
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Stream screen to Kindle display")
-    parser.add_argument("-s", "--server", default="root@192.168.15.244", help="Server name (default: root@192.168.15.244)")
+    parser.add_argument("-s", "--server", nargs="+", default=["root@192.168.15.244"], help="Server name, several to stream to all of them. Append :ROTATION[:WIDTHxHEIGHT] for a Kindle that is mounted differently or has another resolution (default: root@192.168.15.244)")
     parser.add_argument("-r", "--rotation", type=int, default=1, choices=[0, 1, 2, 3], help="Rotation (0, 1, 2, or 3, default: 1)")
     parser.add_argument("-c", "--crop", action="store_true", help="Whether to crop the image (default: False)")
-    parser.add_argument("-d", "--display", type=int, default=1, help="Display number to capture (default: 1)")
+    parser.add_argument("-d", "--display", type=int, default=1, help="Display number to capture on macOS (default: 1)")
+    parser.add_argument("--capture", choices=CAPTURE_BACKENDS, default="auto", help="Where frames come from: the macOS screen, an X11 display (e.g. Xvfb), a framebuffer, a synthetic test pattern or a video file (default: auto, mac on macOS and x11 elsewhere)")
+    parser.add_argument("--capture-source", help="X display for x11 (default: $DISPLAY), device or raw dump for framebuffer (default: /dev/fb0, add :WIDTHxHEIGHT[:BITS] for dumps), WIDTHxHEIGHT for synthetic, the file for video")
+    parser.add_argument("--region", type=parse_region, help="Only capture this part of the screen, as X,Y,WIDTH,HEIGHT")
     parser.add_argument("-b", "--backlight", type=int, default=-1, help="Set the backlight brightness (0 to 4095)")
-    return parser.parse_args()
+    parser.add_argument("--fade", type=fade_seconds, default=0, help="Fade the backlight to --backlight, and back at the end, over this many seconds (at most 65.5)")
+    parser.add_argument("-t", "--full-frame-threshold", type=float, default=0.5, help="Send the full frame instead of regions when more than this fraction of the screen changed (default: 0.5)")
+    parser.add_argument("--format", choices=TRANSFER_FORMATS, default=None, help="Transfer format for frames (default: png, raw with --agent)")
+    parser.add_argument("--dither", choices=DITHER_MODES, default=None, help="Quantize frames to the panel's 16 gray levels with this dithering")
+    parser.add_argument("--refresh-area-budget", type=float, default=5.0, help="Full refresh once the changed area since the last one adds up to this many screens (default: 5.0)")
+    parser.add_argument("--refresh-delta-budget", type=float, default=1.5, help="Full refresh once the gray level change since the last one adds up to this many full black/white flips of the screen (default: 1.5)")
+    parser.add_argument("-l", "--latency-target", type=float, default=None, help="Adapt transfer format, dithering and frame rate to keep full frames under this many seconds (overrides --format and --dither)")
+    parser.add_argument("-i", "--max-idle", type=float, default=60, help="Refresh the display after this many seconds even if the screen didn't change (default: 60)")
+    parser.add_argument("--device-timeout", type=float, default=DEVICE_TIMEOUT, help=f"Give up on a Kindle that doesn't answer during setup and cleanup within this many seconds (default: {DEVICE_TIMEOUT})")
+    parser.add_argument("--stats-interval", type=float, default=10, help="Print rolling latency percentiles and FPS every this many seconds, 0 to disable (default: 10)")
+    parser.add_argument("--stats-file", help="Append the timings of every frame to this file as JSON lines")
+    parser.add_argument("-g", "--agent", action="store_true", help="Send frames to the display agent running on the Kindle, falling back to ssh")
+    args = parser.parse_args()
+    if not args.latency_target:
+        args.format = default_format(args.format, args.agent)
+    return args
+
+def parse_region(text):
+    x, y, width, height = (int(value) for value in text.split(","))
+    return x, y, x + width, y + height
+
+class RefreshScheduler:
+    # Decides when the panel needs a full (flashing) refresh. Partial updates
+    # leave ghosting behind in proportion to how much of the screen changed
+    # and by how many gray levels, so both are accumulated per frame and a
+    # full refresh is due once either exceeds its budget
+    def __init__(self, area_budget, delta_budget):
+        self.area_budget = area_budget
+        self.delta_budget = delta_budget
+        self.area = 0.0
+        self.delta = 0.0
+        self.full_refreshes = 0
+        self.started = time.monotonic()
+
+    def add(self, delta):
+        # delta is the absolute per-pixel difference to the previous frame.
+        # Returns True when a full refresh is due
+        self.area += np.count_nonzero(delta) / delta.size
+        self.delta += float(delta.sum(dtype=np.int64)) / (255 * delta.size)
+        return self.area >= self.area_budget or self.delta >= self.delta_budget
+
+    def reset(self):
+        self.area = 0.0
+        self.delta = 0.0
+        self.full_refreshes += 1
+
+    def status(self):
+        minutes = (time.monotonic() - self.started) / 60
+        return (f"ghosting area {self.area:.2f}/{self.area_budget:.2f}, delta {self.delta:.2f}/{self.delta_budget:.2f}, "
+                f"{self.full_refreshes / minutes if minutes else 0:.1f} full refreshes/min")
+
+class QualityController:
+    # Measures how long full frames take to reach the display and the link's
+    # round trip time, and moves along QUALITY_LADDER to keep frames under
+    # the latency target. When even the most compact format is too slow, or
+    # the round trip dominates the latency, it paces captures to the rate the
+    # link delivers frames at so no work is spent on frames that would only
+    # be dropped. Without a target it just reports the fixed settings
+    def __init__(self, latency_target, transfer_format, dither):
+        self.latency_target = latency_target
+        if latency_target:
+            self.ladder = QUALITY_LADDER
+            self.level = 1
+        else:
+            self.ladder = [(transfer_format, dither)]
+            self.level = 0
+        self.frame_interval = 0.0
+        self.latency = None
+        self.rtt = None
+        self.last_rtt_probe = None
+        self.frames_since_change = 0
+        # Several display stages report to one controller when streaming to more than one Kindle
+        self.lock = threading.Lock()
+
+    @property
+    def transfer_format(self):
+        return self.ladder[self.level][0]
+
+    @property
+    def dither(self):
+        return self.ladder[self.level][1]
+
+    def probe_rtt(self, connection):
+        # Ping one of the Kindles every RTT_PROBE_INTERVAL seconds
+        now = time.monotonic()
+        with self.lock:
+            if self.last_rtt_probe is not None and now - self.last_rtt_probe < RTT_PROBE_INTERVAL:
+                return
+            self.last_rtt_probe = now
+        rtt = ping(connection)
+        with self.lock:
+            self.rtt = rtt
+
+    def record(self, seconds):
+        # Feed the time a full frame took, returns a description of the
+        # decision if the settings changed
+        with self.lock:
+            return self._record(seconds)
+
+    def _record(self, seconds):
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += LATENCY_SMOOTHING * (seconds - self.latency)
+        self.frames_since_change += 1
+        if not self.latency_target or self.frames_since_change < QUALITY_HOLD_FRAMES:
+            return None
+
+        before = self.describe()
+        rtt_bound = self.rtt is not None and self.rtt >= self.latency * RTT_BOUND_SHARE
+        if self.latency > self.latency_target * 1.2:
+            if self.level < len(self.ladder) - 1 and not rtt_bound:
+                self.level += 1
+            else:
+                # The link delivers about one frame per latency, the capture
+                # interval doesn't change how long a frame takes
+                self.frame_interval = min(MAX_FRAME_INTERVAL, round(self.latency, 2))
+        elif self.latency <= self.latency_target:
+            if self.frame_interval > 0:
+                self.frame_interval = 0.0
+            elif self.level > 0 and self.latency < self.latency_target * 0.6:
+                self.level -= 1
+        after = self.describe()
+        if after == before:
+            return None
+        self.frames_since_change = 0
+        return f"{before} -> {after} (latency {self.latency:.2f}s, target {self.latency_target:.2f}s)"
+
+    def describe(self):
+        return f"{self.transfer_format}/{self.dither or 'no dither'}, interval {self.frame_interval:.2f}s"
+
+    def status(self):
+        rtt = f", rtt {self.rtt * 1000:.0f}ms" if self.rtt is not None else ""
+        return self.describe() + rtt
+
+class DisplayGroup:
+    # Kindles that show the same pixels (same rotation and resolution). The
+    # capture is processed and diffed once for the group and the update is
+    # put on every member's own queue, so a slow Kindle only drops its own
+    # frames. Full frames are also encoded once for a group of several
+    # Kindles, region updates are merged per Kindle and encoded by each
+    def __init__(self, args, rotation, size, queues):
+        self.rotation = rotation
+        # Every capture has the same size, so the fit plan is only computed once
+        self.pipeline = ImagePipeline(size=size)
+        self.scheduler = RefreshScheduler(args.refresh_area_budget, args.refresh_delta_budget)
+        self.queues = queues
+        self.previous = None
+
+    def update(self, args, capture, transfer_format, dither, idle_refresh, started, timings):
+        # timings holds the capture's timings so far, the group's own
+        # processing is added on top
+        timings = dict(timings)
+        with timed(timings, "process"):
+            img = self.pipeline.process(capture, args.crop, self.rotation)
+            if dither:
+                img = quantize_image(img, dither)
+            regions = None
+            force_refresh = self.previous is None or idle_refresh
+            if self.previous is not None:
+                delta = frame_delta(self.previous, img)
+                force_refresh = self.scheduler.add(delta) or force_refresh
+                if not force_refresh:
+                    regions = find_dirty_regions(delta != 0, args.full_frame_threshold)
+        if force_refresh:
+            print("full refresh: " + self.scheduler.status())
+            self.scheduler.reset()
+        self.previous = img
+        # (transfer format, data), with a single Kindle its display stage
+        # encodes instead so that work overlaps with processing the next frame
+        encoded = None
+        if regions is None and len(self.queues) > 1:
+            with timed(timings, "encode"):
+                encoded = (transfer_format, encode_image(img, transfer_format))
+        for q in self.queues:
+            put_latest(q, (img, regions, force_refresh, started, timings, encoded), merge_updates)
+
+def frame_delta(previous, current):
+    # Absolute per-pixel gray level difference between two frames
+    return np.abs(np.asarray(current, dtype=np.int16) - np.asarray(previous, dtype=np.int16))
+
+def find_dirty_regions(changed, threshold, tile=DIRTY_TILE_SIZE):
+    # Returns the (left, top, right, bottom) boxes covering the changed pixels,
+    # or None if so much changed that a full frame should be sent instead
+    height, width = changed.shape
+    rows = -(-height // tile)
+    cols = -(-width // tile)
+    padded = np.zeros((rows * tile, cols * tile), dtype=bool)
+    padded[:height, :width] = changed
+    tiles = padded.reshape(rows, tile, cols, tile).any(axis=(1, 3))
+    if not tiles.any():
+        return []
+
+    # Merge horizontal runs of dirty tiles, extending a rectangle downwards
+    # while the next tile row has a run with the same extent
+    regions = []
+    open_regions = {}
+    for row in range(rows + 1):
+        runs = []
+        if row < rows:
+            padded_row = np.concatenate(([False], tiles[row], [False]))
+            edges = np.flatnonzero(padded_row[1:] != padded_row[:-1]).tolist()
+            runs = list(zip(edges[0::2], edges[1::2]))
+        next_open = {}
+        for run in runs:
+            next_open[run] = open_regions.pop(run, row)
+        for (start, end), top in open_regions.items():
+            regions.append((start * tile, top * tile, min(end * tile, width), min(row * tile, height)))
+        open_regions = next_open
+
+    regions = limit_regions(regions)
+
+    dirty_area = sum((right - left) * (bottom - top) for left, top, right, bottom in regions)
+    if dirty_area > threshold * width * height:
+        return None
+    return regions
+
+def limit_regions(regions):
+    # Above MAX_DIRTY_REGIONS rectangles a single bounding box is sent instead
+    if len(regions) <= MAX_DIRTY_REGIONS:
+        return regions
+    lefts, tops, rights, bottoms = zip(*regions)
+    return [(min(lefts), min(tops), max(rights), max(bottoms))]
+
+def merge_updates(older, newer):
+    # A newer frame replaces one the display never got to. Its regions only
+    # cover the changes since the dropped frame, so keep the dropped ones too.
+    # An encoding is only kept if it is of the newer frame
+    older_regions, older_force_refresh = older[1], older[2]
+    img, regions, force_refresh, started, timings, encoded = newer
+    if older_regions is None or regions is None:
+        regions = None
+    else:
+        regions = limit_regions(older_regions + regions)
+    return img, regions, force_refresh or older_force_refresh, started, timings, encoded
+
+def put_latest(q, item, merge=None):
+    # Put item on a bounded queue, replacing whatever is still waiting there
+    # so the consumer always gets the newest frame. Returns True if a frame was dropped
+    try:
+        q.put_nowait(item)
+        return False
+    except queue.Full:
+        pass
+    try:
+        dropped = q.get_nowait()
+        if merge is not None:
+            item = merge(dropped, item)
+    except queue.Empty:
+        dropped = None
+    # Only this thread puts on the queue, so there is room now
+    q.put_nowait(item)
+    return dropped is not None
+
+def get_next(q, stop):
+    # Block until an item is available, returns None once the stream is stopped
+    while not stop.is_set():
+        try:
+            return q.get(timeout=QUEUE_POLL_INTERVAL)
+        except queue.Empty:
+            pass
+    return None
+
+def fingerprint(img):
+    # Cheap identity of a capture, a hash of a downsampled copy. Computed
+    # before any of the expensive processing
+    if img.mode not in ('L', 'RGB', 'RGBA'):
+        img = img.convert('RGB')
+    return hashlib.blake2b(img.reduce(FINGERPRINT_REDUCTION).tobytes(), digest_size=16).digest()
+
+def capture_box(size, groups, crop, region=None):
+    # The part of the screen worth capturing: the region, if given, and when
+    # cropping only what is left of it after every group's crop. None for all of it
+    left, top, right, bottom = region or (0, 0) + size
+    if crop:
+        boxes = [group.pipeline.plan((right - left, bottom - top), group.rotation, True)[2] for group in groups]
+        lefts, tops, rights, bottoms = zip(*boxes)
+        left, top, right, bottom = (left + math.floor(min(lefts)), top + math.floor(min(tops)),
+                                    left + math.ceil(max(rights)), top + math.ceil(max(bottoms)))
+    box = (max(left, 0), max(top, 0), min(right, size[0]), min(bottom, size[1]))
+    return None if box == (0, 0) + size else box
+
+def capture_frames(stop, source, box, captures, idle, controller):
+    # Stage 1: grab the screen (or only box of it) as an in-memory image
+    last_capture = 0.0
+    while not stop.is_set():
+        if idle.is_set():
+            # Nothing changed last time, no need to capture flat out
+            stop.wait(IDLE_CAPTURE_INTERVAL)
+        elif controller.frame_interval:
+            stop.wait(max(0.0, last_capture + controller.frame_interval - time.monotonic()))
+        last_capture = time.monotonic()
+        timings = {}
+        with timed(timings, "capture"):
+            capture = source.grab(box)
+        put_latest(captures, (capture, last_capture, timings))
+
+def process_frames(stop, args, captures, groups, idle, controller):
+    # Stage 2: fit the capture to each group of Kindles and work out what changed
+    last_fingerprint = None
+    last_sent = time.monotonic()
+    while True:
+        item = get_next(captures, stop)
+        if item is None:
+            return
+        capture, started, timings = item
+        timings = dict(timings)
+        # Identical captures are skipped before processing, unless the
+        # display has been idle long enough to deserve a refresh
+        with timed(timings, "process"):
+            frame_fingerprint = fingerprint(capture)
+        idle_refresh = time.monotonic() - last_sent >= args.max_idle
+        if frame_fingerprint == last_fingerprint and not idle_refresh:
+            idle.set()
+            continue
+        idle.clear()
+        last_fingerprint = frame_fingerprint
+        last_sent = time.monotonic()
+
+        for group in groups:
+            group.update(args, capture, controller.transfer_format, controller.dither, idle_refresh, started, timings)
+
+def display_frames(stop, connection, updates, controller, stats):
+    # Stage 3: encode, transfer and draw the newest update on one Kindle
+    counter = 0
+    failures = 0
+    while True:
+        update = get_next(updates, stop)
+        if update is None:
+            return
+        img, regions, force_refresh, started, timings, encoded = update
+        timings = dict(timings)
+        if failures:
+            # The last update may not have arrived, regions alone could leave stale areas
+            regions, force_refresh = None, True
+        transfer_format = controller.transfer_format
+        sent = 0
+        try:
+            if controller.latency_target:
+                controller.probe_rtt(connection)
+            if regions is None and encoded is not None and encoded[0] == transfer_format:
+                with timed(timings, "send"):
+                    sent = send_encoded(encoded[1], connection, force_refresh=force_refresh, negative=False, transfer_format=transfer_format)
+            elif regions is None:
+                sent = send_image(img, connection, force_refresh=force_refresh, negative=False, transfer_format=transfer_format, timings=timings)
+            elif regions:
+                sent = send_regions(img, regions, connection, negative=False, transfer_format=transfer_format, timings=timings)
+        except (OSError, subprocess.CalledProcessError, AgentError) as e:
+            # Keep going with the next frame, the other Kindles aren't affected
+            failures += 1
+            print(f"{connection.server}: frame failed ({e}), {failures}/{MAX_DEVICE_FAILURES}")
+            if failures >= MAX_DEVICE_FAILURES:
+                print(f"{connection.server}: giving up")
+                return
+            continue
+        failures = 0
+        timings["latency"] = time.monotonic() - started
+        stats.record(server=connection.server, bytes=sent, full_refresh=regions is None and force_refresh,
+                     regions=None if regions is None else len(regions), **timings)
+        seconds = timings.get("encode", 0.0) + timings.get("send", 0.0)
+        counter += 1
+        print(f"{connection.server} frame: " + str(counter) + ("" if regions is None else f" ({len(regions)} regions)")
+              + f", {sent / 1024:.0f} KB in {seconds:.2f}s, {controller.status()}")
+        # Only full frames are comparable with each other
+        if regions is None:
+            decision = controller.record(seconds)
+            if decision:
+                print("quality: " + decision)
+
+def start_stage(name, target, stop, errors, *args):
+    # Run one pipeline stage in a thread, any error stops the whole stream
+    def run():
+        try:
+            target(stop, *args)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    return thread
 
 def main():
     args = parse_arguments()
-    OUTPUT_FILENAME = "screen.png"
-    FORCE_REFRESH_INTERVAL = 10
+    source = open_capture(args.capture, args.capture_source, args.display)
 
-    # Keep the display alive
-    keep_alive(True, args.server)
+    # Open one ssh session per Kindle and reuse it for every frame. Kindles
+    # that don't answer within the device timeout are left out of the stream
+    backlights = {}
+    def setup(server):
+        connection = get_connection(server, AGENT_PORT if args.agent else None).connect()
+        # Keep the display alive
+        keep_alive(True, connection)
+        # Get the actual backlight brightness
+        backlights[server] = get_actual_backlight(connection)
+        # Set the backlight brightness
+        if args.backlight != -1:
+            set_backlight(args.backlight, connection, args.fade)
 
-    # Get the actual backlight brightness
-    backlight = get_actual_backlight(args.server)
-    # Set the backlight brightness
-    if args.backlight != -1:
-        set_backlight(args.backlight, args.server)
+    failures = run_on_targets(setup, [parse_target(spec)[0] for spec in args.server], args.device_timeout)
+    for server, error in failures.items():
+        print(f"Skipping Kindle at {server}: {error}")
+    targets = [spec for spec in args.server if parse_target(spec)[0] not in failures]
+    if not targets:
+        raise SystemExit("No Kindle to stream to")
 
-    counter = 0
+    # Capture, processing and display run concurrently, connected by
+    # single-slot queues where a new frame replaces one still waiting.
+    # Every Kindle has its own display stage and update queue
+    captures = queue.Queue(maxsize=1)
+    controller = QualityController(args.latency_target, args.format, args.dither)
+    stats = FrameStats(args.stats_interval, args.stats_file)
+    stop = threading.Event()
+    idle = threading.Event()
+    errors = []
+    groups = []
+    displays = []
+    for (rotation, size), servers in group_targets(targets, args.rotation).items():
+        queues = [queue.Queue(maxsize=1) for _ in servers]
+        groups.append(DisplayGroup(args, rotation, size, queues))
+        for server, updates in zip(servers, queues):
+            displays.append(start_stage("display " + server, display_frames, stop, errors, get_connection(server), updates, controller, stats))
+    box = capture_box(source.size, groups, args.crop, args.region)
+    if box is not None:
+        print(f"Capturing {box[2] - box[0]}x{box[3] - box[1]} at {box[0]},{box[1]} of the {source.size[0]}x{source.size[1]} screen")
+    stages = [
+        start_stage("capture", capture_frames, stop, errors, source, box, captures, idle, controller),
+        start_stage("process", process_frames, stop, errors, args, captures, groups, idle, controller),
+    ] + displays
     try:
-        while True:
-            os.system(f"screencapture -x -D {args.display} -r {OUTPUT_FILENAME}")
-            if counter%FORCE_REFRESH_INTERVAL == 0:
-                display_image(OUTPUT_FILENAME, args.server, rotation=args.rotation, force_refresh=True, negative=False, crop=args.crop)
-            else:
-                display_image(OUTPUT_FILENAME, args.server, rotation=args.rotation, force_refresh=False, negative=False, crop=args.crop)
-            os.remove(OUTPUT_FILENAME)
-            counter += 1
-            print("frame: " + str(counter))
-            
+        while not stop.wait(QUEUE_POLL_INTERVAL):
+            if not any(display.is_alive() for display in displays):
+                raise RuntimeError("Lost every Kindle, stopping")
+        if errors:
+            raise errors[0]
+
     except KeyboardInterrupt:
         print("Screen streaming stopped.")
     finally:
-        # Disable the display keep-alive
-        keep_alive(False, args.server)
-        # Set the backlight brightness back to its original value
-        set_backlight(backlight, args.server)
+        stop.set()
+        for stage in stages:
+            stage.join()
+        print("stats: " + stats.summary())
+        stats.close()
+        source.close()
+
+        def cleanup(server):
+            # Disable the display keep-alive
+            keep_alive(False, server)
+            # Set the backlight brightness back to its original value, a
+            # no-op if it was never changed
+            set_backlight(backlights[server], server, args.fade)
+            get_connection(server).close()
+
+        for server, error in run_on_targets(cleanup, list(backlights), args.device_timeout).items():
+            print(f"Failed to restore Kindle at {server}: {error}")
 
 if __name__ == "__main__":
     main()